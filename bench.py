@@ -0,0 +1,439 @@
+"""Офлайн-бенчмарк бота: локальные заглушки hh.ru и Telegram Bot API
+
+Запуск:
+    python bench.py --users 10000 --output bench.json
+
+Скрипт поднимает локальный /vacancies с настраиваемой задержкой, размером выдачи
+и долей ошибок, а также Bot API, принимающий sendMessage. Затем генерирует
+пользователей с реалистичным пересечением ключевых слов (распределение Ципфа),
+прогоняет несколько циклов check_new_vacancies, серию /search и сохранений
+и печатает результаты в JSON, чтобы сравнивать версии между собой.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import statistics
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Вакансии публикуются в последние сутки, чтобы бот не удалял их как устаревшие (VACANCY_TTL_DAYS)
+BASE_TIME = datetime.now(timezone(timedelta(hours=3))).replace(microsecond=0) - timedelta(days=1)
+
+WORDS = [
+    "python", "java", "golang", "frontend", "backend", "devops", "qa", "data", "ml", "ios",
+    "android", "media", "buyer", "designer", "product", "project", "manager", "analyst",
+    "support", "sales", "marketing", "smm", "copywriter", "recruiter", "1c", "php", "react"
+]
+LEVELS = ["junior", "middle", "senior", "lead", ""]
+
+class FakeHh:
+    """Заглушка hh.ru: у каждого запроса свой поток вакансий, пополняемый каждый цикл"""
+
+    def __init__(self, latency, items, new_per_cycle, error_rate, seed):
+        self.latency = latency
+        self.items = items
+        self.new_per_cycle = new_per_cycle
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.cycle = 0
+        self.queries = {}
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def query_index(self, text):
+        with self.lock:
+            return self.queries.setdefault(text.lower(), len(self.queries))
+
+    def vacancy(self, query_index, text, number):
+        published = BASE_TIME + timedelta(minutes=number * 7 + query_index % 7)
+        return {
+            "id": str(query_index * 100000 + number),
+            "name": f"{text} #{number} [remote_team]",
+            "alternate_url": f"https://hh.ru/vacancy/{query_index * 100000 + number}",
+            "employer": {"name": f"Employer_{number % 97}", "logo_urls": {"90": "https://example.com/logo.png"}},
+            "salary": {"from": 100000 + number, "to": None, "currency": "RUR", "gross": False} if number % 3 else None,
+            "published_at": published.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "snippet": {"requirement": "Опыт работы " * 10, "responsibility": "Задачи " * 10},
+            "area": {"id": "1", "name": "Москва"},
+            "schedule": {"id": "remote", "name": "Удаленная работа"}
+        }
+
+    def search(self, params):
+        text = params.get("text", [""])[0].replace("NAME:", "").strip('"')
+        per_page = int(params.get("per_page", ["20"])[0])
+        page = int(params.get("page", ["0"])[0])
+        date_from = params.get("date_from", [None])[0]
+
+        query_index = self.query_index(text)
+        total = self.items + self.cycle * self.new_per_cycle
+        numbers = range(total - 1, -1, -1)
+        if date_from:
+            threshold = datetime.strptime(date_from, "%Y-%m-%dT%H:%M:%S%z")
+            numbers = [n for n in numbers if BASE_TIME + timedelta(minutes=n * 7 + query_index % 7) >= threshold]
+        numbers = list(numbers)[:2000]
+
+        page_numbers = numbers[page * per_page:(page + 1) * per_page]
+        return {
+            "found": len(numbers),
+            "pages": math.ceil(len(numbers) / per_page),
+            "page": page,
+            "per_page": per_page,
+            "items": [self.vacancy(query_index, text, n) for n in page_numbers]
+        }
+
+class FakeBotApi:
+    """Заглушка Telegram Bot API: принимает getMe и sendMessage"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.messages = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def handle(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "sendMessage":
+            with self.lock:
+                self.messages += 1
+                self.bytes += len(str(params.get("text", "")).encode("utf-8"))
+            return {
+                "message_id": self.messages,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")
+            }
+        return True
+
+def start_server(handler_factory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_factory)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_hh_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            with fake.lock:
+                fake.requests += 1
+            time.sleep(fake.latency)
+            if fake.random.random() < fake.error_rate:
+                with fake.lock:
+                    fake.errors += 1
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = json.dumps(fake.search(parse_qs(url.query)), ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+def make_bot_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length).decode("utf-8")
+            try:
+                params = json.loads(raw) if raw else {}
+            except ValueError:
+                params = {key: values[0] for key, values in parse_qs(raw).items()}
+            time.sleep(fake.latency)
+            method = self.path.rstrip("/").rsplit("/", 1)[-1]
+            body = json.dumps({"ok": True, "result": fake.handle(method, params)}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+def keyword_pool(size, seed):
+    """Пул ключевых фраз"""
+    rnd = random.Random(seed)
+    pool = set()
+    while len(pool) < size:
+        phrase = " ".join(filter(None, [rnd.choice(LEVELS), rnd.choice(WORDS), rnd.choice(WORDS)]))
+        pool.add(phrase)
+    return sorted(pool)
+
+def zipf_weights(size, exponent):
+    return [1 / (rank ** exponent) for rank in range(1, size + 1)]
+
+class LoopLagMonitor:
+    """Измерение задержки цикла событий: насколько позже срабатывает sleep"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self.task = None
+        self.started = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - self.started - self.interval)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self):
+        # Sleep, начатый до конца фазы, ещё не проснулся: фаза, которая ни разу
+        # не отдала управление циклу, иначе показала бы нулевую задержку
+        samples = list(self.samples)
+        if self.started is not None:
+            pending = asyncio.get_running_loop().time() - self.started - self.interval
+            if pending > 0:
+                samples.append(pending)
+        if not samples:
+            return {"max_ms": 0, "p99_ms": 0, "mean_ms": 0}
+        samples.sort()
+        return {
+            "max_ms": round(samples[-1] * 1000, 2),
+            "p99_ms": round(samples[int(len(samples) * 0.99) - 1] * 1000, 2),
+            "mean_ms": round(statistics.fmean(samples) * 1000, 2)
+        }
+
+class BenchJob:
+    removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+class BenchJobQueue:
+    """Очередь задач без таймеров: циклы проверки запускает сам бенчмарк"""
+
+    def run_once(self, callback, when):
+        return BenchJob()
+
+class BenchMessage:
+    def __init__(self, counter):
+        self.counter = counter
+
+    async def reply_text(self, text, **kwargs):
+        self.counter["replies"] += 1
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+async def wait_delivery(hhbot, timeout):
+    started = time.perf_counter()
+    while len(hhbot.delivery) and time.perf_counter() - started < timeout:
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+async def run(args, hhbot, fake_hh, fake_bot, bot_api_url):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    result = {
+        "version": git_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "params": vars(args),
+        "cycles": []
+    }
+
+    # Генерация пользователей
+    pool = keyword_pool(args.keywords, args.seed)
+    weights = zipf_weights(len(pool), args.zipf)
+    rnd = random.Random(args.seed)
+    started = time.perf_counter()
+    hhbot.load_data()
+    with hhbot.storage.batch():
+        for user_id in range(1, args.users + 1):
+            hhbot.init_user_data(user_id)
+            count = max(1, int(rnd.gauss(args.keywords_per_user, 1)))
+            for keyword in set(rnd.choices(pool, weights, k=count)):
+                hhbot.user_data[str(user_id)]["keywords"].append(keyword)
+            hhbot.save_data(user_id)
+    hhbot.user_data.clear()
+    result["populate_seconds"] = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    hhbot.rebuild_keyword_index()
+    hhbot.load_schedule()
+    result["startup_seconds"] = round(time.perf_counter() - started, 3)
+    result["distinct_keywords"] = len(hhbot.keyword_index)
+
+    # Пул соединений как у Application.builder() в bot.py (по умолчанию 256),
+    # иначе воркеры доставки упираются в одно соединение Bot по умолчанию
+    tg_bot = Bot(args.token, base_url=f"{bot_api_url}/bot",
+                 request=HTTPXRequest(connection_pool_size=256))
+    await tg_bot.initialize()
+    hhbot.delivery.start(tg_bot)
+    context = SimpleNamespace(bot=tg_bot, job_queue=BenchJobQueue())
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+
+    for cycle in range(args.cycles):
+        fake_hh.cycle = cycle
+        # Все пользователи становятся «просроченными» к началу цикла
+        now = time.time()
+        for user_id in list(hhbot.scheduler.due_at):
+            hhbot.scheduler.schedule(user_id, now)
+
+        requests_before, errors_before = fake_hh.requests, fake_hh.errors
+        messages_before = fake_bot.messages
+        monitor.samples.clear()
+
+        started = time.perf_counter()
+        await hhbot.check_new_vacancies(context)
+        cycle_seconds = time.perf_counter() - started
+        drain_seconds = await wait_delivery(hhbot, args.delivery_timeout)
+
+        result["cycles"].append({
+            "cycle": cycle,
+            "wall_seconds": round(cycle_seconds, 3),
+            "delivery_drain_seconds": round(drain_seconds, 3),
+            "hh_requests": fake_hh.requests - requests_before,
+            "hh_errors": fake_hh.errors - errors_before,
+            "messages_sent": fake_bot.messages - messages_before,
+            "messages_undelivered": len(hhbot.delivery),
+            "loop_lag": monitor.report()
+        })
+
+    # Интерактивный /search для выборки пользователей
+    counter = {"replies": 0}
+    sample = rnd.sample(range(1, args.users + 1), min(args.searches, args.users))
+    latencies = []
+
+    async def one_search(user_id):
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=BenchMessage(counter))
+        started = time.perf_counter()
+        await hhbot.search_vacancies(update, context)
+        latencies.append(time.perf_counter() - started)
+
+    requests_before = fake_hh.requests
+    monitor.samples.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(one_search(user_id) for user_id in sample))
+    result["search"] = {
+        "count": len(sample),
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "hh_requests": fake_hh.requests - requests_before,
+        "replies": counter["replies"],
+        "loop_lag": monitor.report()
+    }
+
+    # Сохранение отдельных пользователей
+    durations = []
+    for user_id in sample:
+        hhbot.get_user(user_id)
+        started = time.perf_counter()
+        hhbot.save_data(user_id)
+        durations.append(time.perf_counter() - started)
+    result["save_data"] = {
+        "count": len(durations),
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 3)
+    }
+
+    await monitor.stop()
+    await hhbot.delivery.stop()
+    await tg_bot.shutdown()
+    await hhbot.close_http_client()
+    hhbot.storage.close()
+
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота hh.ru")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--keywords", type=int, default=300, help="размер пула ключевых фраз")
+    parser.add_argument("--keywords-per-user", type=float, default=3)
+    parser.add_argument("--zipf", type=float, default=1.1, help="показатель Ципфа для популярности фраз")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--items", type=int, default=100, help="вакансий по запросу в первом цикле")
+    parser.add_argument("--new-per-cycle", type=int, default=5, help="новых вакансий по запросу за цикл")
+    parser.add_argument("--hh-latency", type=float, default=0.05)
+    parser.add_argument("--hh-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.01)
+    parser.add_argument("--searches", type=int, default=50)
+    parser.add_argument("--storage", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--delivery-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--token", default="123456:BENCH")
+    parser.add_argument("--output", help="файл для результатов (по умолчанию stdout)")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    fake_hh = FakeHh(args.hh_latency, args.items, args.new_per_cycle, args.hh_error_rate, args.seed)
+    fake_bot = FakeBotApi(args.tg_latency)
+    hh_server = start_server(make_hh_handler(fake_hh))
+    bot_server = start_server(make_bot_handler(fake_bot))
+
+    # Бот читает настройки при импорте, поэтому окружение готовим заранее
+    workdir = tempfile.mkdtemp(prefix="hhbench-")
+    os.environ.update({
+        "HH_API_URL": f"http://127.0.0.1:{hh_server.server_address[1]}",
+        "STORAGE_BACKEND": args.storage,
+        "DB_FILE": os.path.join(workdir, "bench.db"),
+        "CHECK_SPREAD": "1",
+        "HH_RPS": os.environ.get("HH_RPS", "1000"),
+        "TG_GLOBAL_RATE": os.environ.get("TG_GLOBAL_RATE", "1000"),
+        "TG_CHAT_RATE": os.environ.get("TG_CHAT_RATE", "1000")
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import bot as hhbot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(run(args, hhbot, fake_hh, fake_bot, f"http://127.0.0.1:{bot_server.server_address[1]}"))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    hh_server.shutdown()
+    bot_server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,32 @@
 import os
+import re
 import time
+import signal
+import socket
+import bisect
+import hashlib
+import asyncio
+import sys
+import cProfile
+import pstats
+import threading
+import traceback
+import tracemalloc
 import logging
 import json
-import requests
-from datetime import datetime, timedelta
+import sqlite3
+import base64
+import html
+import heapq
+import zlib
+import httpx
+from array import array
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
 # Настройка логирования
@@ -15,42 +37,915 @@ logger = logging.getLogger(__name__)
 TOKEN = os.environ.get("TELEGRAM_TOKEN", "YOUR_TELEGRAM_TOKEN")
 CHECK_INTERVAL = int(os.environ.get("CHECK_INTERVAL", "3600"))  # По умолчанию проверка каждый час
 DATA_FILE = "user_data.json"
+KEYWORDS_FILE = "keyword_state.json"  # Состояние запросов для JSON-хранилища
+OUTBOX_FILE = "outbox.json"  # Неотправленные уведомления для JSON-хранилища
+DB_FILE = os.environ.get("DB_FILE", "bot.db")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")  # sqlite или json
+SQLITE_TIMEOUT = float(os.environ.get("SQLITE_TIMEOUT", "30"))  # Сколько секунд ждать блокировки базы другим процессом
+SEEN_TTL_DAYS = int(os.environ.get("SEEN_TTL_DAYS", "30"))  # Сколько дней помнить показанные вакансии
+SEEN_MAX_SIZE = int(os.environ.get("SEEN_MAX_SIZE", "5000"))  # Максимум запомненных вакансий на пользователя
+USER_CACHE_IDLE = int(os.environ.get("USER_CACHE_IDLE", "3600"))  # Через сколько секунд без команд данные пользователя выгружаются из памяти
 
-# Структура данных пользователей
+# Настройки HTTP-клиента hh.ru
+HH_API_URL = os.environ.get("HH_API_URL", "https://api.hh.ru")
+HH_CONNECT_TIMEOUT = float(os.environ.get("HH_CONNECT_TIMEOUT", "5"))
+HH_READ_TIMEOUT = float(os.environ.get("HH_READ_TIMEOUT", "15"))
+HH_MAX_CONNECTIONS = int(os.environ.get("HH_MAX_CONNECTIONS", "10"))  # Одновременных запросов к hh.ru
+HH_PER_PAGE = 100  # Максимальное количество вакансий на страницу
+HH_MAX_DEPTH = 2000  # hh.ru не отдает больше 2000 результатов на запрос
+CHECK_WORKERS = int(os.environ.get("CHECK_WORKERS", "4"))  # Параллельных задач в цикле проверки
+CHECK_SPREAD = int(os.environ.get("CHECK_SPREAD", "300"))  # Окно (сек) для распределения просроченных проверок
+CHECK_BATCH_SIZE = int(os.environ.get("CHECK_BATCH_SIZE", "25"))  # Пользователей в одной порции (транзакции) цикла проверки
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "25"))  # Сообщений в секунду всего (лимит Telegram ~30)
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", "8"))  # Параллельных отправителей уведомлений
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get("DELIVERY_MAX_ATTEMPTS", "5"))  # Попыток отправки одного сообщения
+HH_RPS = float(os.environ.get("HH_RPS", "5"))  # Запросов к hh.ru в секунду
+HH_RETRY_AFTER = float(os.environ.get("HH_RETRY_AFTER", "10"))  # Пауза после 429, если hh.ru не указал свою
+HH_BREAKER_THRESHOLD = int(os.environ.get("HH_BREAKER_THRESHOLD", "5"))  # Ошибок подряд до размыкания предохранителя
+HH_BREAKER_COOLDOWN = float(os.environ.get("HH_BREAKER_COOLDOWN", "60"))  # Пауза (сек) при разомкнутом предохранителе
+INGEST_MODE = os.environ.get("INGEST_MODE", "query")  # query - запрос на каждое ключевое слово, firehose - общий поток
+FIREHOSE_INTERVAL = int(os.environ.get("FIREHOSE_INTERVAL", "300"))  # Период (сек) получения общего потока вакансий
+WATERMARK_OVERLAP = int(os.environ.get("WATERMARK_OVERLAP", "600"))  # На сколько секунд раньше отметки запрашивать вакансии (повторы отсеиваются)
+VACANCY_TTL_DAYS = int(os.environ.get("VACANCY_TTL_DAYS", "30"))  # Сколько дней хранить полученные вакансии
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", "5"))  # Параллельных запросов к hh.ru на один /search
+SEARCH_STALE_SECONDS = int(os.environ.get("SEARCH_STALE_SECONDS", "900"))  # Через сколько секунд локальный индекс запроса устаревает
+HH_CACHE_TTL = float(os.environ.get("HH_CACHE_TTL", "60"))  # Время жизни (сек) ответов hh.ru в кэше
+HH_CACHE_MAX_ITEMS = int(os.environ.get("HH_CACHE_MAX_ITEMS", "20000"))  # Максимум вакансий во всех ответах кэша
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "20000"))  # Готовых блоков вакансий в кэше /search
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # Порт HTTP-эндпоинта метрик Prometheus (0 - выключен)
+PENDING_MAX_SIZE = int(os.environ.get("PENDING_MAX_SIZE", "500"))  # Максимум ожидающих отправки вакансий на пользователя
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")  # Каталог для результатов профилирования
+PROFILE_CYCLES = int(os.environ.get("PROFILE_CYCLES", "0"))  # Профилировать столько ближайших циклов проверки
+PROFILE_HANDLERS = int(os.environ.get("PROFILE_HANDLERS", "0"))  # Профилировать столько ближайших вызовов команд
+PROFILE_TOP = 30  # Строк в текстовом отчете профилирования
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", "0"))  # Блокировка цикла событий (сек), о которой сообщать (0 - выключено)
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get("ADMIN_IDS", "").split(",") if user_id.strip()}  # Администраторы бота
+ENRICH_DETAILS = os.environ.get("ENRICH_DETAILS", "0") == "1"  # Получать полные тексты вакансий для фильтрации по описанию
+DETAILS_DB_FILE = os.environ.get("DETAILS_DB_FILE", "details.db")  # Файл кэша текстов вакансий
+DETAIL_CONCURRENCY = int(os.environ.get("DETAIL_CONCURRENCY", "4"))  # Одновременных запросов текстов вакансий
+DETAIL_CACHE_TTL_DAYS = int(os.environ.get("DETAIL_CACHE_TTL_DAYS", "7"))  # Сколько дней хранить тексты вакансий
+DETAIL_CACHE_MAX_ITEMS = int(os.environ.get("DETAIL_CACHE_MAX_ITEMS", "50000"))  # Максимум текстов вакансий в кэше
+DIGEST_MAX_VACANCIES = int(os.environ.get("DIGEST_MAX_VACANCIES", "50"))  # Дайджест отправляется досрочно, если накопилось столько вакансий
+BOT_ROLE = os.environ.get("BOT_ROLE", "all")  # all - все в одном процессе, front - только Telegram, worker - только проверки
+WORKER_ID = os.environ.get("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")  # Имя рабочего процесса
+WORKER_HEARTBEAT = float(os.environ.get("WORKER_HEARTBEAT", "15"))  # Период (сек) пульса и синхронизации рабочего процесса
+WORKER_TTL = float(os.environ.get("WORKER_TTL", "60"))  # Через сколько секунд без пульса процесс считается остановленным
+RING_REPLICAS = 64  # Точек на кольце консистентного хеширования на один процесс
+# На Heroku и подобных платформах HTTP-запросы получает только процесс web: для webhook
+# задайте UPDATE_MODE=webhook и WEBHOOK_URL и замените в Procfile "worker:" на "web:"
+UPDATE_MODE = os.environ.get("UPDATE_MODE", "polling")  # polling - опрос getUpdates, webhook - Telegram присылает обновления сам
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Публичный адрес бота (https://example.com), к нему добавляется путь
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")  # Адрес, на котором принимаются обновления
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))  # Порт приема обновлений (PORT задают Heroku и подобные платформы)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")  # Путь приема обновлений
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None  # Секрет в заголовке X-Telegram-Bot-Api-Secret-Token
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))  # Обновлений, обрабатываемых одновременно
+
+# Поля записи пользователя, которые изменяет процесс этой роли (None - запись целиком)
+USER_FIELDS = {
+    "front": ("keywords", "exclude_words", "notification_enabled", "check_interval", "digest_interval", "seen"),
+    "worker": ("seen", "pending", "last_check", "last_digest")
+}.get(BOT_ROLE)
+
+# Общий HTTP-клиент с пулом keep-alive соединений и семафор для ограничения параллельных запросов
+http_client = None
+hh_semaphore = asyncio.Semaphore(HH_MAX_CONNECTIONS)
+check_semaphore = asyncio.Semaphore(CHECK_WORKERS)
+
+# Метрики Prometheus
+HH_REQUEST_SECONDS = Histogram("hh_request_seconds", "Длительность запроса к hh.ru")
+HH_REQUESTS = Counter("hh_requests_total", "Запросы к hh.ru по статусу ответа", ["status"])
+HH_FETCHES = Counter("hh_fetches_total", "Получение вакансий по запросу", ["result"])
+SAVE_DATA_SECONDS = Histogram("save_data_seconds", "Длительность сохранения данных пользователей")
+CHECK_CYCLE_SECONDS = Histogram(
+    "check_cycle_seconds", "Длительность цикла проверки",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+CHECK_STAGE_SECONDS = Histogram("check_stage_seconds", "Длительность этапов цикла проверки", ["stage"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кэшам", ["cache", "result"])
+HH_CACHE_HITS = CACHE_REQUESTS.labels(cache="hh", result="hit")
+HH_CACHE_COALESCED = CACHE_REQUESTS.labels(cache="hh", result="coalesced")
+HH_CACHE_MISSES = CACHE_REQUESTS.labels(cache="hh", result="miss")
+RENDER_CACHE_HITS = CACHE_REQUESTS.labels(cache="render", result="hit")
+RENDER_CACHE_MISSES = CACHE_REQUESTS.labels(cache="render", result="miss")
+DETAIL_CACHE_HITS = CACHE_REQUESTS.labels(cache="details", result="hit")
+DETAIL_CACHE_MISSES = CACHE_REQUESTS.labels(cache="details", result="miss")
+NEW_VACANCIES = Counter("new_vacancies_total", "Новые вакансии, добавленные в очередь пользователям")
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Длительность отправки сообщения в Telegram")
+MESSAGES_SENT = Counter("telegram_messages_sent_total", "Отправленные уведомления")
+SEND_FAILURES = Counter("telegram_send_failures_total", "Ошибки отправки уведомлений", ["reason"])
+USERS = Gauge("users", "Пользователи с включенными уведомлениями")
+DISTINCT_KEYWORDS = Gauge("distinct_keywords", "Уникальные ключевые слова")
+SCHEDULER_BACKLOG = Gauge("scheduler_backlog", "Пользователи, чья проверка просрочена")
+DELIVERY_BACKLOG = Gauge("delivery_backlog", "Сообщения в очереди отправки")
+LOOP_STALLS = Counter("event_loop_stalls_total", "Блокировки цикла событий дольше порога")
+
+# Кэш данных пользователей в памяти (заполняется по мере обращения)
 user_data = {}
 
+# Время последней команды пользователя (time.monotonic), чтобы не выгружать активных
+user_activity = {}
+
+# Хранилище данных пользователей (создается в load_data)
+storage = None
+
+# Обратный индекс: нормализованное ключевое слово -> множество ID подписанных пользователей
+keyword_index = {}
+
+# Дата публикации самой свежей полученной вакансии по каждому запросу
+keyword_watermarks = {}
+FIREHOSE_KEY = ":firehose"  # Отметка общего потока вакансий
+
+def normalize_keyword(keyword):
+    """Нормализация ключевого слова для общего индекса (регистр и пробелы)"""
+    return " ".join(keyword.lower().split())
+
+# Слово для сопоставления: буквы и цифры с точками внутри или в начале (.net, node.js)
+# и плюсами или решетками в конце (c++, c#); остальные знаки разделяют слова
+MATCH_TOKEN = re.compile(r"\.?[^\W_]+(?:\.[^\W_]+)*[+#]*")
+
+def match_text(text):
+    """Текст для сопоставления целых слов: нижний регистр, слова через один пробел
+    
+    >>> match_text("Senior C++/C# (.NET) developer, Node.js")
+    'senior c++ c# .net developer node.js'
+    >>> match_text("Objective-C разработчик.")
+    'objective c разработчик'
+    """
+    return " ".join(MATCH_TOKEN.findall(text.lower()))
+
+class KeywordMatcher:
+    """Поиск всех ключевых фраз в тексте за один проход (автомат Ахо — Корасик)
+    
+    Фразы добавляются в бор по мере появления, суффиксные ссылки
+    пересчитываются перед ближайшим поиском после изменений.
+    """
+    
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]  # Фраза, заканчивающаяся в узле
+        self.output_link = [0]  # Ближайший по суффиксным ссылкам узел с фразой
+        self.dirty = False
+    
+    def add(self, pattern):
+        node = 0
+        for char in pattern:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.output_link.append(0)
+                self.goto[node][char] = next_node
+            node = next_node
+        self.output[node] = pattern
+        self.dirty = True
+    
+    def remove(self, pattern):
+        node = 0
+        for char in pattern:
+            node = self.goto[node].get(char)
+            if node is None:
+                return
+        self.output[node] = None
+        self.dirty = True
+    
+    def build(self):
+        """Пересчет суффиксных ссылок обходом бора в ширину"""
+        queue = deque()
+        for node in self.goto[0].values():
+            self.fail[node] = 0
+            self.output_link[node] = 0
+            queue.append(node)
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail
+                self.output_link[child] = fail if self.output[fail] is not None else self.output_link[fail]
+                queue.append(child)
+        self.dirty = False
+    
+    def find(self, text):
+        """Фразы, встречающиеся в тексте целыми словами (text - результат match_text)"""
+        if self.dirty:
+            self.build()
+        found = set()
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            match = node if self.output[node] is not None else self.output_link[node]
+            while match:
+                pattern = self.output[match]
+                start = position - len(pattern) + 1
+                end = position + 1
+                if (start == 0 or text[start - 1] == " ") and (end == len(text) or text[end] == " "):
+                    found.add(pattern)
+                match = self.output_link[match]
+        return found
+
+keyword_matcher = KeywordMatcher()
+
+# Фраза автомата (результат match_text) -> ключевые слова индекса, которым она соответствует
+keyword_patterns = {}
+
+def index_add_keyword(user_id, keyword):
+    """Добавление подписки пользователя на ключевое слово в индекс"""
+    normalized = normalize_keyword(keyword)
+    if normalized not in keyword_index:
+        keyword_index[normalized] = set()
+        pattern = match_text(normalized)
+        if pattern:
+            if pattern not in keyword_patterns:
+                keyword_patterns[pattern] = set()
+                keyword_matcher.add(pattern)
+            keyword_patterns[pattern].add(normalized)
+    keyword_index[normalized].add(str(user_id))
+
+def index_remove_keyword(user_id, keyword):
+    """Удаление подписки пользователя из индекса, если у него не осталось равнозначных ключевых слов"""
+    normalized = normalize_keyword(keyword)
+    if any(normalize_keyword(kw) == normalized for kw in user_data[str(user_id)]["keywords"]):
+        return
+    subscribers = keyword_index.get(normalized)
+    if subscribers is not None:
+        subscribers.discard(str(user_id))
+        if not subscribers:
+            del keyword_index[normalized]
+            pattern = match_text(normalized)
+            keywords = keyword_patterns.get(pattern)
+            if keywords is not None:
+                keywords.discard(normalized)
+                if not keywords:
+                    del keyword_patterns[pattern]
+                    keyword_matcher.remove(pattern)
+
+def rebuild_keyword_index(user_settings=None):
+    """Полная перестройка индекса ключевых слов по данным пользователей (или только переданных)"""
+    global keyword_matcher
+    keyword_index.clear()
+    keyword_patterns.clear()
+    keyword_matcher = KeywordMatcher()
+    items = user_settings.items() if user_settings is not None else storage.iter_user_settings()
+    for user_id, settings in items:
+        for keyword in settings["keywords"]:
+            index_add_keyword(user_id, keyword)
+    logger.info(f"Индекс ключевых слов построен: {len(keyword_index)} уникальных запросов")
+
+class SeenVacancies:
+    """Множество показанных пользователю вакансий с вытеснением по возрасту
+    
+    ID хранятся в отсортированных массивах по дню первого показа и ищутся двоичным
+    поиском; устаревший день удаляется целиком. Новые ID до ближайшего evict
+    копятся в небольшом словаре.
+    """
+    
+    __slots__ = ("buckets", "recent")
+    
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else {}  # день -> отсортированный array("I") ID
+        self.recent = {}  # ID вакансии -> день показа (еще не перенесенные в buckets)
+    
+    def __contains__(self, vacancy_id):
+        vacancy_id = int(vacancy_id)
+        if vacancy_id in self.recent:
+            return True
+        # Начинаем с последних дней: повторно приходят в основном свежие вакансии
+        for bucket in reversed(self.buckets.values()):
+            index = bisect.bisect_left(bucket, vacancy_id)
+            if index < len(bucket) and bucket[index] == vacancy_id:
+                return True
+        return False
+    
+    def __len__(self):
+        return len(self.recent) + sum(len(bucket) for bucket in self.buckets.values())
+    
+    def add(self, vacancy_id, day=None):
+        vacancy_id = int(vacancy_id)
+        if vacancy_id not in self:
+            self.recent[vacancy_id] = day if day is not None else current_day()
+    
+    def items(self):
+        """Пары (ID вакансии, день показа)"""
+        for day, bucket in self.buckets.items():
+            for vacancy_id in bucket:
+                yield vacancy_id, day
+        yield from self.recent.items()
+    
+    def merge(self, other):
+        """Объединение с другой копией множества (например, сохраненной другим процессом)"""
+        known = set(self.recent)
+        for bucket in self.buckets.values():
+            known.update(bucket)
+        for vacancy_id, day in other.items():
+            if vacancy_id not in known:
+                self.recent[vacancy_id] = day
+    
+    def evict(self, today=None):
+        """Перенос новых ID в массивы дней, удаление устаревших дней и ограничение размера"""
+        today = today if today is not None else current_day()
+        min_day = today - SEEN_TTL_DAYS
+        added = {}
+        for vacancy_id, day in self.recent.items():
+            added.setdefault(day, []).append(vacancy_id)
+        self.recent = {}
+        
+        buckets = {}
+        for day in sorted(self.buckets.keys() | added.keys()):
+            if day <= min_day:
+                continue
+            bucket = self.buckets.get(day)
+            if day in added:
+                ids = added[day]
+                if bucket is not None:
+                    ids.extend(bucket)
+                bucket = array("I", sorted(ids))
+            buckets[day] = bucket
+        
+        # Сверх лимита сначала удаляются самые старые дни целиком
+        size = sum(len(bucket) for bucket in buckets.values())
+        for day in list(buckets):
+            if size <= SEEN_MAX_SIZE:
+                break
+            bucket = buckets[day]
+            excess = size - SEEN_MAX_SIZE
+            if len(bucket) <= excess:
+                del buckets[day]
+                size -= len(bucket)
+            else:
+                # ID на hh.ru растут со временем: в пределах дня остаются самые новые
+                buckets[day] = bucket[excess:]
+                size -= excess
+        self.buckets = buckets
+    
+    def to_json(self):
+        """Компактное представление: упакованные массивы ID и дней в base64"""
+        ids = array("I")
+        days = array("I")
+        for day, bucket in self.buckets.items():
+            ids.extend(bucket)
+            days.extend(array("I", [day]) * len(bucket))
+        ids.extend(self.recent.keys())
+        days.extend(self.recent.values())
+        return {
+            "ids": base64.b64encode(ids.tobytes()).decode("ascii"),
+            "days": base64.b64encode(days.tobytes()).decode("ascii")
+        }
+    
+    @classmethod
+    def from_json(cls, value):
+        ids = array("I")
+        days = array("I")
+        ids.frombytes(base64.b64decode(value["ids"]))
+        days.frombytes(base64.b64decode(value["days"]))
+        groups = {}
+        for vacancy_id, day in zip(ids, days):
+            groups.setdefault(day, []).append(vacancy_id)
+        return cls({day: array("I", sorted(set(groups[day]))) for day in sorted(groups)})
+
+def current_day():
+    """Номер текущего дня (для возраста записей о показанных вакансиях)"""
+    return int(time.time() // 86400)
+
+def json_default(obj):
+    """Сериализация вспомогательных объектов в данных пользователя"""
+    if hasattr(obj, "to_json"):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class JsonStorage:
+    """Хранение всех пользователей в одном JSON-файле (прежний формат)"""
+    
+    def __init__(self, path, keywords_path, outbox_path):
+        self.path = path
+        self.keywords_path = keywords_path
+        self.outbox_path = outbox_path
+        self.journal_path = f"{outbox_path}.log"
+        self.batch_depth = 0
+        self.dirty = set()  # Файлы, измененные с последней записи
+        self.users = self.read(path, {})
+        self.watermarks = self.read(keywords_path, {})
+        # id -> [chat_id, текст, parse_mode]: снимок очереди и журнал изменений после него
+        self.outbox = {message[0]: message[1:] for message in self.read(outbox_path, [])}
+        self.journal = []  # Еще не записанные в журнал изменения очереди
+        self.journal_size = 0
+        self.replay_journal()
+        self.next_message_id = max(self.outbox, default=0) + 1
+    
+    def load_user(self, user_id):
+        return self.users.get(user_id)
+    
+    def save_user(self, user_id, data):
+        self.users[user_id] = data
+        self.dirty.add("users")
+        if not self.batch_depth:
+            self.flush()
+    
+    def iter_user_settings(self):
+        for user_id, data in self.users.items():
+            yield user_id, data
+    
+    def load_watermarks(self):
+        return dict(self.watermarks)
+    
+    def save_watermark(self, keyword, watermark):
+        self.watermarks[keyword] = watermark
+        self.dirty.add("keywords")
+        if not self.batch_depth:
+            self.flush()
+    
+    def store_vacancies(self, vacancies, keyword=None):
+        # В JSON-хранилище полученные вакансии не сохраняются
+        pass
+    
+    def link_vacancies(self, keyword, vacancies):
+        pass
+    
+    def prune_vacancies(self, before):
+        pass
+    
+    def search_vacancies(self, keyword, limit):
+        # Локальный поиск не поддерживается: вызывающий обращается к hh.ru
+        return None
+    
+    def add_outbox(self, chat_id, text, parse_mode):
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        self.outbox[message_id] = [chat_id, text, parse_mode]
+        self.journal.append(["add", message_id, chat_id, text, parse_mode])
+        if not self.batch_depth:
+            self.flush()
+        return message_id
+    
+    def delete_outbox(self, message_id):
+        if self.outbox.pop(message_id, None) is None:
+            return
+        self.journal.append(["delete", message_id])
+        if not self.batch_depth:
+            self.flush()
+    
+    def load_outbox(self):
+        return [(message_id, message[0]) for message_id, message in self.outbox.items()]
+    
+    def load_outbox_message(self, message_id):
+        message = self.outbox.get(message_id)
+        return None if message is None else tuple(message[1:])
+    
+    @contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush()
+    
+    def flush(self):
+        """Атомарная запись измененных файлов через временный файл"""
+        if "users" in self.dirty:
+            self.write(self.path, self.users)
+        if "keywords" in self.dirty:
+            self.write(self.keywords_path, self.watermarks)
+        self.dirty.clear()
+        if self.journal:
+            self.flush_journal()
+    
+    def flush_journal(self):
+        """Дозапись изменений очереди в журнал; длинный журнал сворачивается в снимок
+        
+        Отправка каждого сообщения дописывает в журнал одну строку, а не переписывает
+        всю очередь, поэтому доставка не замедляется с ростом очереди.
+        """
+        with open(self.journal_path, 'a', encoding='utf-8') as file:
+            file.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in self.journal)
+        self.journal_size += len(self.journal)
+        self.journal = []
+        if self.journal_size > max(1000, len(self.outbox)):
+            self.compact_journal()
+    
+    def compact_journal(self):
+        """Запись снимка очереди и удаление журнала
+        
+        Повторное применение журнала к новому снимку ничего не меняет,
+        поэтому сбой между записью снимка и удалением журнала безопасен.
+        """
+        self.write(self.outbox_path, [[message_id, *message] for message_id, message in self.outbox.items()])
+        os.remove(self.journal_path)
+        self.journal_size = 0
+    
+    def replay_journal(self):
+        """Применение журнала очереди к снимку при запуске и сворачивание журнала"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Недописанная при сбое строка
+                    logger.warning(f"Пропущена поврежденная запись журнала {self.journal_path}")
+                    continue
+                if entry[0] == "add":
+                    self.outbox[entry[1]] = entry[2:]
+                else:
+                    self.outbox.pop(entry[1], None)
+        # Новые записи не должны продолжать недописанную строку
+        self.compact_journal()
+    
+    def read(self, path, default):
+        """Чтение файла; поврежденный файл откладывается в .broken, чтобы не потерять остальные"""
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except ValueError as e:
+            logger.error(f"Ошибка при загрузке {path}, файл сохранен как {path}.broken: {e}")
+            os.replace(path, f"{path}.broken")
+            return default
+    
+    def write(self, path, content):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(content, file, ensure_ascii=False, indent=4, default=json_default)
+        os.replace(tmp_path, path)
+    
+    def close(self):
+        self.flush()
+
+class SqliteStorage:
+    """Хранение пользователей в SQLite (WAL), по одной строке на пользователя"""
+    
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=SQLITE_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS keywords (keyword TEXT PRIMARY KEY, watermark TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vacancies (id INTEGER PRIMARY KEY, published_at TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS vacancies_published_at ON vacancies (published_at)")
+        # Какие вакансии hh.ru вернул по каждому запросу (поиск отвечает по ним, а не по совпадению названий)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS keyword_vacancies "
+            "(keyword TEXT NOT NULL, vacancy_id INTEGER NOT NULL, PRIMARY KEY (keyword, vacancy_id)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS keyword_vacancies_vacancy_id ON keyword_vacancies (vacancy_id)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, text TEXT NOT NULL, parse_mode TEXT)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (user_id TEXT PRIMARY KEY, worker_id TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self.batch_depth = 0
+    
+    def load_user(self, user_id):
+        row = self.conn.execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save_user(self, user_id, data):
+        self.conn.execute(
+            "INSERT INTO users (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            (user_id, json.dumps(data, ensure_ascii=False, default=json_default))
+        )
+    
+    def save_user_fields(self, user_id, data, fields):
+        """Запись только указанных полей (остальные поля записи изменяют другие процессы)"""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)",
+            (user_id, json.dumps(data, ensure_ascii=False, default=json_default))
+        )
+        paths = ", ".join(f"'$.{field}', json(?)" for field in fields)
+        self.conn.execute(
+            f"UPDATE users SET data = json_set(data, {paths}) WHERE user_id = ?",
+            [json.dumps(data.get(field), ensure_ascii=False, default=json_default) for field in fields] + [user_id]
+        )
+    
+    def load_seen(self, user_id):
+        """Сохраненное множество показанных вакансий пользователя (None, если его нет)"""
+        row = self.conn.execute(
+            "SELECT json_extract(data, '$.seen') FROM users WHERE user_id = ? AND json_type(data, '$.seen') = 'object'",
+            (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def iter_user_settings(self):
+        """Настройки пользователей без загрузки полных записей"""
+        rows = self.conn.execute(
+            "SELECT user_id, json_extract(data, '$.keywords'), json_extract(data, '$.notification_enabled'), "
+            "json_extract(data, '$.check_interval'), json_extract(data, '$.last_check'), "
+            "json_extract(data, '$.digest_interval'), json_extract(data, '$.exclude_words') FROM users"
+        ).fetchall()
+        for user_id, keywords, notification_enabled, check_interval, last_check, digest_interval, exclude_words in rows:
+            yield user_id, {
+                "keywords": json.loads(keywords) if keywords else [],
+                "exclude_words": json.loads(exclude_words) if exclude_words else [],
+                "notification_enabled": bool(notification_enabled),
+                "check_interval": check_interval,
+                "last_check": last_check,
+                "digest_interval": digest_interval or 0
+            }
+    
+    def load_watermarks(self):
+        return dict(self.conn.execute("SELECT keyword, watermark FROM keywords").fetchall())
+    
+    def save_watermark(self, keyword, watermark):
+        self.conn.execute(
+            "INSERT INTO keywords (keyword, watermark) VALUES (?, ?) "
+            "ON CONFLICT(keyword) DO UPDATE SET watermark = excluded.watermark",
+            (keyword, watermark)
+        )
+    
+    def store_vacancies(self, vacancies, keyword=None):
+        """Сохранение полученных вакансий в локальный индекс (дата публикации в UTC для сортировки и очистки)
+        
+        Если указан запрос, вакансии связываются с ним.
+        """
+        if not vacancies:
+            return
+        with self.batch():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO vacancies (id, published_at, data) VALUES (?, ?, ?)",
+                [
+                    (
+                        vacancy.id,
+                        vacancy.published_at.astimezone(timezone.utc).isoformat(),
+                        json.dumps(vacancy.to_json(), ensure_ascii=False)
+                    )
+                    for vacancy in vacancies
+                ]
+            )
+            if keyword is not None:
+                self.link_vacancies(keyword, vacancies)
+    
+    def link_vacancies(self, keyword, vacancies):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO keyword_vacancies (keyword, vacancy_id) VALUES (?, ?)",
+            [(keyword, vacancy.id) for vacancy in vacancies]
+        )
+    
+    def prune_vacancies(self, before):
+        """Удаление вакансий, опубликованных раньше указанного времени (UTC)"""
+        with self.batch():
+            self.conn.execute(
+                "DELETE FROM keyword_vacancies WHERE vacancy_id IN (SELECT id FROM vacancies WHERE published_at < ?)",
+                (before.isoformat(),)
+            )
+            self.conn.execute("DELETE FROM vacancies WHERE published_at < ?", (before.isoformat(),))
+    
+    def search_vacancies(self, keyword, limit):
+        """Сохраненные вакансии, полученные с hh.ru по запросу, самые свежие вначале"""
+        rows = self.conn.execute(
+            "SELECT v.data FROM keyword_vacancies k JOIN vacancies v ON v.id = k.vacancy_id "
+            "WHERE k.keyword = ? ORDER BY v.published_at DESC LIMIT ?",
+            (keyword, limit)
+        ).fetchall()
+        return [Vacancy.from_json(json.loads(row[0])) for row in rows]
+    
+    def add_outbox(self, chat_id, text, parse_mode):
+        cursor = self.conn.execute(
+            "INSERT INTO outbox (chat_id, text, parse_mode) VALUES (?, ?, ?)", (chat_id, text, parse_mode)
+        )
+        return cursor.lastrowid
+    
+    def delete_outbox(self, message_id):
+        self.conn.execute("DELETE FROM outbox WHERE id = ?", (message_id,))
+    
+    def load_outbox(self):
+        return self.conn.execute("SELECT id, chat_id FROM outbox ORDER BY id").fetchall()
+    
+    def load_chat_outbox(self, chat_id):
+        rows = self.conn.execute("SELECT id FROM outbox WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+        return [row[0] for row in rows]
+    
+    def load_outbox_message(self, message_id):
+        return self.conn.execute("SELECT text, parse_mode FROM outbox WHERE id = ?", (message_id,)).fetchone()
+    
+    def heartbeat(self, worker_id, now, ttl):
+        """Отметка о работе процесса; возвращает список работающих процессов"""
+        with self.batch():
+            self.conn.execute(
+                "INSERT INTO workers (worker_id, heartbeat) VALUES (?, ?) "
+                "ON CONFLICT(worker_id) DO UPDATE SET heartbeat = excluded.heartbeat",
+                (worker_id, now)
+            )
+            self.conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - ttl,))
+            rows = self.conn.execute("SELECT worker_id FROM workers ORDER BY worker_id").fetchall()
+        return [row[0] for row in rows]
+    
+    def claim_users(self, worker_id, user_ids, now, ttl):
+        """Продление аренды своих пользователей и захват свободных
+        
+        Пользователь, арендованный другим процессом, остается за ним, пока аренда
+        не истечет или не будет освобождена. Непродленная аренда своих пользователей
+        освобождается. Возвращает множество арендованных процессом пользователей.
+        """
+        expires = now + ttl
+        with self.batch():
+            self.conn.executemany(
+                "INSERT INTO leases (user_id, worker_id, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET worker_id = excluded.worker_id, expires = excluded.expires "
+                "WHERE leases.worker_id = excluded.worker_id OR leases.expires < ?",
+                [(user_id, worker_id, expires, now) for user_id in user_ids]
+            )
+            self.conn.execute("DELETE FROM leases WHERE worker_id = ? AND expires < ?", (worker_id, expires))
+            rows = self.conn.execute("SELECT user_id FROM leases WHERE worker_id = ?", (worker_id,)).fetchall()
+        return {row[0] for row in rows}
+    
+    def leave(self, worker_id):
+        """Освобождение аренды и удаление процесса при остановке"""
+        with self.batch():
+            self.conn.execute("DELETE FROM leases WHERE worker_id = ?", (worker_id,))
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+    
+    @contextmanager
+    def batch(self):
+        """Объединение нескольких изменений в одну транзакцию"""
+        if self.batch_depth:
+            self.batch_depth += 1
+            try:
+                yield
+            finally:
+                self.batch_depth -= 1
+            return
+        
+        # Блокировка записи берется сразу: чтение и запись в транзакции не пересекаются с другими процессами
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.batch_depth = 1
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+        finally:
+            self.batch_depth = 0
+    
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+    
+    def migrate_from_json(self, path):
+        """Однократный перенос данных из JSON-файла"""
+        with open(path, 'r', encoding='utf-8') as file:
+            users = json.load(file)
+        with self.batch():
+            for user_id, data in users.items():
+                self.save_user(user_id, data)
+        os.replace(path, f"{path}.migrated")
+        logger.info(f"Перенесено {len(users)} пользователей из {path} в SQLite")
+    
+    def close(self):
+        self.conn.close()
+
+class VacancyDetailCache:
+    """Кэш текстов вакансий (описание и ключевые навыки) на диске, общий для всех пользователей
+    
+    Устаревшие записи не возвращаются и удаляются при очистке, при превышении
+    размера удаляются записи, полученные раньше остальных.
+    """
+    
+    def __init__(self, path, ttl, max_items):
+        self.conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS vacancy_details (id INTEGER PRIMARY KEY, fetched_at REAL NOT NULL, text TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS vacancy_details_fetched_at ON vacancy_details (fetched_at)")
+        self.conn.commit()
+        self.ttl = ttl
+        self.max_items = max_items
+    
+    def get_many(self, vacancy_ids):
+        details = {}
+        vacancy_ids = list(vacancy_ids)
+        # Ограничение SQLite на число параметров запроса
+        for start in range(0, len(vacancy_ids), 500):
+            chunk = vacancy_ids[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT id, text FROM vacancy_details WHERE fetched_at >= ? AND id IN ({', '.join('?' * len(chunk))})",
+                [time.time() - self.ttl, *chunk]
+            ).fetchall()
+            details.update(rows)
+        return details
+    
+    def put_many(self, details):
+        if not details:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO vacancy_details (id, fetched_at, text) VALUES (?, ?, ?)",
+                [(vacancy_id, now, text) for vacancy_id, text in details.items()]
+            )
+            self.conn.execute("DELETE FROM vacancy_details WHERE fetched_at < ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM vacancy_details WHERE id IN "
+                "(SELECT id FROM vacancy_details ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_items,)
+            )
+    
+    def close(self):
+        self.conn.close()
+
+# Кэш текстов вакансий (создается в load_data, если включено получение текстов)
+detail_cache = None
+
 def load_data():
-    """Загрузка данных пользователей из файла"""
-    global user_data
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as file:
-                user_data = json.load(file)
-            logger.info("Данные пользователей загружены")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке данных: {e}")
-        user_data = {}
+    """Подключение хранилища данных пользователей"""
+    global storage, detail_cache
+    if STORAGE_BACKEND == "json":
+        storage = JsonStorage(DATA_FILE, KEYWORDS_FILE, OUTBOX_FILE)
+    else:
+        storage = SqliteStorage(DB_FILE)
+        if storage.is_empty() and os.path.exists(DATA_FILE):
+            storage.migrate_from_json(DATA_FILE)
+    keyword_watermarks.update(storage.load_watermarks())
+    if ENRICH_DETAILS:
+        detail_cache = VacancyDetailCache(DETAILS_DB_FILE, DETAIL_CACHE_TTL_DAYS * 86400, DETAIL_CACHE_MAX_ITEMS)
+    logger.info(f"Хранилище данных пользователей подключено: {STORAGE_BACKEND}")
 
-def save_data():
-    """Сохранение данных пользователей в файл"""
+def save_data(user_id=None):
+    """Сохранение данных пользователя (или всех загруженных пользователей)
+    
+    Ошибка записи не скрывается: вызывающий (и пользователь) должен узнать,
+    что изменения не сохранены.
+    """
+    user_ids = [str(user_id)] if user_id is not None else list(user_data)
     try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as file:
-            json.dump(user_data, file, ensure_ascii=False, indent=4)
-        logger.info("Данные пользователей сохранены")
+        with SAVE_DATA_SECONDS.time(), storage.batch():
+            for uid in user_ids:
+                if USER_FIELDS is None:
+                    storage.save_user(uid, user_data[uid])
+                else:
+                    merge_stored_seen(uid)
+                    storage.save_user_fields(uid, user_data[uid], USER_FIELDS)
     except Exception as e:
         logger.error(f"Ошибка при сохранении данных: {e}")
+        raise
+
+def merge_stored_seen(user_id):
+    """Добавление вакансий, отмеченных показанными другим процессом, перед записью"""
+    stored = storage.load_seen(str(user_id))
+    if stored is not None:
+        get_seen(user_id).merge(SeenVacancies.from_json(stored))
+
+def get_user(user_id):
+    """Получение данных пользователя из кэша или хранилища"""
+    user_id = str(user_id)
+    if user_id not in user_data:
+        data = storage.load_user(user_id)
+        if data is None:
+            return None
+        data["pending"] = [Vacancy.from_json(vacancy) for vacancy in data.get("pending", [])]
+        user_data[user_id] = data
+    return user_data[user_id]
+
+def get_seen(user_id):
+    """Множество показанных вакансий пользователя (с переносом из старого формата)"""
+    data = user_data[str(user_id)]
+    seen = data.get("seen")
+    if isinstance(seen, SeenVacancies):
+        return seen
+    
+    if seen:
+        seen = SeenVacancies.from_json(seen)
+    else:
+        seen = SeenVacancies()
+        for vacancy_id in data.pop("last_vacancies", []):
+            seen.add(vacancy_id)
+    data["seen"] = seen
+    return seen
 
 def init_user_data(user_id):
     """Инициализация данных нового пользователя"""
-    if str(user_id) not in user_data:
+    user_activity[str(user_id)] = time.monotonic()
+    if get_user(user_id) is None:
         user_data[str(user_id)] = {
             "keywords": [],
+            "exclude_words": [],
             "last_check": None,
-            "last_vacancies": [],
+            "seen": SeenVacancies(),
+            "pending": [],
             "notification_enabled": True,
-            "check_interval": CHECK_INTERVAL
+            "check_interval": CHECK_INTERVAL,
+            "digest_interval": 0
         }
-        save_data()
+        save_data(user_id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
@@ -73,6 +968,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Пример: /add_keywords \"junior media buyer\" \"python разработчик\"\n\n"
         "/remove_keywords - Удалить ключевые слова\n"
         "/list_keywords - Показать текущие ключевые слова\n"
+        "/exclude\\_words - Не присылать вакансии с указанными словами\n"
         "/search - Выполнить поиск вакансий сейчас\n"
         "/settings - Настройки уведомлений\n"
         "/help - Показать эту справку\n\n"
@@ -81,57 +977,65 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
     await update.message.reply_text(help_text, parse_mode="Markdown")
 
-async def add_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик команды /add_keywords"""
-    user_id = update.effective_user.id
-    init_user_data(user_id)
-    
-    if not context.args:
-        await update.message.reply_text(
-            "Укажите ключевые слова в кавычках для поиска точных фраз.\n"
-            "Пример: /add_keywords \"junior media buyer\" \"python разработчик\"\n\n"
-            "⚠️ Важно: Используйте кавычки для каждой отдельной фразы!"
-        )
-        return
-    
+def parse_phrases(args):
+    """Фразы в кавычках и отдельные слова без кавычек из аргументов команды"""
     # Объединяем аргументы в строку для анализа
-    input_text = ' '.join(context.args)
+    input_text = ' '.join(args)
     
     # Ищем все фразы в кавычках
-    new_keywords = []
+    phrases = []
     in_quotes = False
-    current_keyword = ""
+    current_phrase = ""
     
     for char in input_text:
         if char == '"' and not in_quotes:
             in_quotes = True
         elif char == '"' and in_quotes:
             in_quotes = False
-            if current_keyword.strip():
-                new_keywords.append(current_keyword.strip())
-            current_keyword = ""
+            if current_phrase.strip():
+                phrases.append(current_phrase.strip())
+            current_phrase = ""
         elif in_quotes:
-            current_keyword += char
+            current_phrase += char
     
-    # Если остались слова без кавычек, добавляем их как отдельные ключевые слова
+    # Если остались слова без кавычек, добавляем их как отдельные фразы
     remaining = input_text
-    for keyword in new_keywords:
-        remaining = remaining.replace(f'"{keyword}"', '')
+    for phrase in phrases:
+        remaining = remaining.replace(f'"{phrase}"', '')
     
     for word in remaining.split():
         if word.strip() and word.strip() != '"':
-            new_keywords.append(word.strip())
+            phrases.append(word.strip())
+    return phrases
+
+async def add_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /add_keywords"""
+    user_id = update.effective_user.id
+    init_user_data(user_id)
+    
+    if not context.args:
+        await update.message.reply_text(
+            "Укажите ключевые слова в кавычках для поиска точных фраз.\n"
+            "Пример: /add_keywords \"junior media buyer\" \"python разработчик\"\n\n"
+            "⚠️ Важно: Используйте кавычки для каждой отдельной фразы!"
+        )
+        return
+    
+    new_keywords = parse_phrases(context.args)
     
     # Добавление ключевых слов
     added_keywords = []
     for keyword in new_keywords:
         if keyword and keyword not in user_data[str(user_id)]["keywords"]:
             user_data[str(user_id)]["keywords"].append(keyword)
+            index_add_keyword(user_id, keyword)
             added_keywords.append(keyword)
     
-    save_data()
+    save_data(user_id)
     
     if added_keywords:
+        # Ставим в очередь проверок сразу: поиск ниже может не выполниться, если hh.ru недоступен
+        schedule_user(user_id, context.job_queue)
         keywords_list = "\n• ".join(user_data[str(user_id)]["keywords"])
         await update.message.reply_text(
             f"✅ Добавлены ключевые слова: {', '.join(added_keywords)}\n\n"
@@ -177,6 +1081,40 @@ async def list_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     keywords_list = "\n• ".join([f'"{kw}"' for kw in user_data[str(user_id)]["keywords"]])
     await update.message.reply_text(f"🔍 Ваши ключевые слова:\n• {keywords_list}")
 
+async def exclude_words(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /exclude_words"""
+    user_id = update.effective_user.id
+    init_user_data(user_id)
+    data = user_data[str(user_id)]
+    where = "в названии или описании" if ENRICH_DETAILS else "в названии"
+    
+    if not context.args:
+        current = data.get("exclude_words", [])
+        words_list = "\n• ".join(f'"{word}"' for word in current) if current else "нет"
+        await update.message.reply_text(
+            f"🚫 Вакансии, {where} которых есть эти слова, не присылаются.\n"
+            "Пример: /exclude_words стажировка \"без опыта\"\n"
+            "Очистить список: /exclude_words -\n\n"
+            f"Текущие слова:\n• {words_list}"
+        )
+        return
+    
+    if context.args == ["-"]:
+        data["exclude_words"] = []
+        save_data(user_id)
+        await update.message.reply_text("✅ Список исключаемых слов очищен.")
+        return
+    
+    words = data.setdefault("exclude_words", [])
+    for phrase in parse_phrases(context.args):
+        word = match_text(phrase)
+        if word and word not in words:
+            words.append(word)
+    save_data(user_id)
+    
+    words_list = "\n• ".join(f'"{word}"' for word in words)
+    await update.message.reply_text(f"✅ Не присылаю вакансии, {where} которых есть:\n• {words_list}")
+
 async def search_vacancies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /search и поиск вакансий"""
     user_id = update.effective_user.id
@@ -189,101 +1127,126 @@ async def search_vacancies(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return
     
-    await update.message.reply_text("🔍 Ищу вакансии на hh.ru...")
-    
-    # Получаем вакансии для каждого ключевого слова
-    all_vacancies = []
+    # Сначала отвечаем из локального индекса: на hh.ru идем только за запросами,
+    # которых в индексе нет, а устаревшие обновляем в фоне
+    local_vacancies = []
+    network_keywords = []
     for keyword in user_data[str(user_id)]["keywords"]:
+        normalized = normalize_keyword(keyword)
+        vacancies = storage.search_vacancies(normalized, HH_PER_PAGE)
+        if not vacancies:
+            network_keywords.append(keyword)
+            continue
+        local_vacancies.extend(vacancies)
+        if index_is_stale(normalized):
+            refresh_in_background(normalized)
+    
+    # Результаты отправляются по мере готовности, дубликаты отсекаются по ID
+    vacancy_ids = set()
+    seen = get_seen(user_id)
+    excluded = user_data[str(user_id)].get("exclude_words")
+    
+    async def send_batch(vacancies):
+        # Во время поиска тексты вакансий не запрашиваются, используются только уже сохраненные
+        details = detail_cache.get_many(vacancy.id for vacancy in vacancies) if excluded and detail_cache else {}
+        unique_vacancies = []
+        for vacancy in vacancies:
+            if excluded and is_excluded(vacancy, excluded, details):
+                continue
+            if vacancy.id not in vacancy_ids:
+                unique_vacancies.append(vacancy)
+                vacancy_ids.add(vacancy.id)
+                seen.add(vacancy.id)
+        
+        # Сортируем по дате публикации (самые свежие вначале)
+        unique_vacancies.sort(key=lambda x: x.published_at, reverse=True)
+        for message in pack_messages(render_vacancies(unique_vacancies)):
+            await update.message.reply_text(message, parse_mode="HTML", disable_web_page_preview=True)
+    
+    await send_batch(local_vacancies)
+    
+    if network_keywords:
+        await update.message.reply_text("🔍 Ищу вакансии на hh.ru...")
+    
+    # Запросы по ключевым словам выполняются параллельно (не больше SEARCH_CONCURRENCY одновременно)
+    search_semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    
+    async def fetch(keyword):
         # Используем специальный формат поиска для точного соответствия
         # Для hh.ru поиск по заголовку вакансии с оператором "name:"
-        vacancies = fetch_vacancies(f'NAME:"{keyword}"')
-        if vacancies:
-            all_vacancies.extend(vacancies)
+        async with search_semaphore:
+            try:
+                vacancies = await fetch_vacancies(f'NAME:"{keyword}"')
+            except HhApiError:
+                return keyword, None
+        index_vacancies(normalize_keyword(keyword), vacancies, complete=True)
+        return keyword, vacancies
     
-    # Удаляем дубликаты
-    unique_vacancies = []
-    vacancy_ids = set()
-    for vacancy in all_vacancies:
-        if vacancy["id"] not in vacancy_ids:
-            unique_vacancies.append(vacancy)
-            vacancy_ids.add(vacancy["id"])
+    failed_keywords = []
+    for task in asyncio.as_completed([fetch(keyword) for keyword in network_keywords]):
+        keyword, vacancies = await task
+        if vacancies is None:
+            failed_keywords.append(keyword)
+        else:
+            await send_batch(vacancies)
     
-    # Сортируем по дате публикации (самые свежие вначале)
-    unique_vacancies.sort(key=lambda x: x["published_at"], reverse=True)
+    if failed_keywords:
+        await update.message.reply_text(
+            "⚠️ hh.ru сейчас не отвечает, не удалось выполнить поиск по запросам: "
+            f"{', '.join(failed_keywords)}. Попробуйте позже."
+        )
+        if len(failed_keywords) == len(user_data[str(user_id)]["keywords"]):
+            return
     
     # Сохраняем ID вакансий для будущих проверок
-    user_data[str(user_id)]["last_vacancies"] = [v["id"] for v in unique_vacancies]
+    seen.evict()
     user_data[str(user_id)]["last_check"] = datetime.now().isoformat()
-    save_data()
+    save_data(user_id)
+    schedule_user(user_id, context.job_queue)
     
-    if not unique_vacancies:
+    if not vacancy_ids:
         await update.message.reply_text(
             "🔍 По вашим ключевым словам не найдено вакансий в режиме удаленной работы.\n"
             "Я буду уведомлять вас, когда появятся новые вакансии."
         )
         return
     
-    # Отправляем результаты
-    await update.message.reply_text(f"🔍 Найдено {len(unique_vacancies)} вакансий:")
-    
-    # Группируем по 10 вакансий для избежания ограничений Telegram
-    chunks = [unique_vacancies[i:i+10] for i in range(0, len(unique_vacancies), 10)]
-    
-    for chunk in chunks:
-        message = ""
-        for vacancy in chunk:
-            published_date = datetime.fromisoformat(vacancy["published_at"].replace("Z", "+00:00"))
-            published_str = published_date.strftime("%d.%m.%Y %H:%M")
-            
-            salary_info = "Зарплата не указана"
-            if vacancy["salary"]:
-                from_salary = vacancy["salary"]["from"] if vacancy["salary"]["from"] else ""
-                to_salary = vacancy["salary"]["to"] if vacancy["salary"]["to"] else ""
-                currency = vacancy["salary"]["currency"] if vacancy["salary"]["currency"] else ""
-                
-                if from_salary and to_salary:
-                    salary_info = f"{from_salary} - {to_salary} {currency}"
-                elif from_salary:
-                    salary_info = f"от {from_salary} {currency}"
-                elif to_salary:
-                    salary_info = f"до {to_salary} {currency}"
-            
-            message += f"[{vacancy['name']}]({vacancy['alternate_url']})\n"
-            message += f"🏢 {vacancy['employer']['name']}\n"
-            message += f"💰 {salary_info}\n"
-            message += f"📅 {published_str}\n\n"
-        
-        await update.message.reply_text(message, parse_mode="Markdown", disable_web_page_preview=True)
-    
     await update.message.reply_text(
-        "✅ Поиск завершен! Я буду уведомлять вас о новых вакансиях.\n"
+        f"✅ Поиск завершен! Найдено {len(vacancy_ids)} вакансий.\n"
+        "Я буду уведомлять вас о новых вакансиях.\n"
         "Вы можете изменить настройки уведомлений с помощью /settings."
     )
 
-async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик команды /settings"""
-    user_id = update.effective_user.id
-    init_user_data(user_id)
-    
-    notification_status = "включены" if user_data[str(user_id)]["notification_enabled"] else "выключены"
-    check_interval_hours = user_data[str(user_id)]["check_interval"] // 3600
+def settings_keyboard(data):
+    """Кнопки меню настроек с текущими значениями"""
+    notification_status = "включены" if data["notification_enabled"] else "выключены"
+    check_interval_hours = data["check_interval"] // 3600
+    digest_hours = data.get("digest_interval", 0) // 3600
+    digest_status = f"раз в {digest_hours} ч" if digest_hours else "выключен"
     
     keyboard = [
         [InlineKeyboardButton(
-            f"{'🔔' if user_data[str(user_id)]['notification_enabled'] else '🔕'} Уведомления: {notification_status}",
+            f"{'🔔' if data['notification_enabled'] else '🔕'} Уведомления: {notification_status}",
             callback_data="toggle_notifications"
         )],
         [InlineKeyboardButton(f"⏱ Интервал проверки: {check_interval_hours} ч", callback_data="change_interval")],
+        [InlineKeyboardButton(f"📬 Дайджест: {digest_status}", callback_data="change_digest")],
         [InlineKeyboardButton("✅ Готово", callback_data="settings_done")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /settings"""
+    user_id = update.effective_user.id
+    init_user_data(user_id)
     
-    await update.message.reply_text("⚙️ Настройки:", reply_markup=reply_markup)
+    await update.message.reply_text("⚙️ Настройки:", reply_markup=settings_keyboard(user_data[str(user_id)]))
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик кнопок"""
     query = update.callback_query
     user_id = query.from_user.id
+    init_user_data(user_id)
     
     await query.answer()
     
@@ -296,7 +1259,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         if keyword in user_data[str(user_id)]["keywords"]:
             user_data[str(user_id)]["keywords"].remove(keyword)
-            save_data()
+            index_remove_keyword(user_id, keyword)
+            save_data(user_id)
         
         # Обновляем кнопки
         keyboard = []
@@ -314,22 +1278,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     elif query.data == "toggle_notifications":
         user_data[str(user_id)]["notification_enabled"] = not user_data[str(user_id)]["notification_enabled"]
-        save_data()
-        
-        notification_status = "включены" if user_data[str(user_id)]["notification_enabled"] else "выключены"
-        check_interval_hours = user_data[str(user_id)]["check_interval"] // 3600
+        save_data(user_id)
+        schedule_user(user_id, context.job_queue)
         
-        keyboard = [
-            [InlineKeyboardButton(
-                f"{'🔔' if user_data[str(user_id)]['notification_enabled'] else '🔕'} Уведомления: {notification_status}",
-                callback_data="toggle_notifications"
-            )],
-            [InlineKeyboardButton(f"⏱ Интервал проверки: {check_interval_hours} ч", callback_data="change_interval")],
-            [InlineKeyboardButton("✅ Готово", callback_data="settings_done")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text("⚙️ Настройки:", reply_markup=reply_markup)
+        await query.edit_message_text("⚙️ Настройки:", reply_markup=settings_keyboard(user_data[str(user_id)]))
     
     elif query.data == "change_interval":
         intervals = [1, 3, 6, 12, 24]
@@ -352,190 +1304,1453 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif query.data.startswith("set_interval_"):
         hours = int(query.data[13:])  # Отрезаем "set_interval_"
         user_data[str(user_id)]["check_interval"] = hours * 3600
-        save_data()
-        
-        notification_status = "включены" if user_data[str(user_id)]["notification_enabled"] else "выключены"
+        save_data(user_id)
+        schedule_user(user_id, context.job_queue)
         
+        await query.edit_message_text("⚙️ Настройки:", reply_markup=settings_keyboard(user_data[str(user_id)]))
+    
+    elif query.data == "change_digest":
         keyboard = [
-            [InlineKeyboardButton(
-                f"{'🔔' if user_data[str(user_id)]['notification_enabled'] else '🔕'} Уведомления: {notification_status}",
-                callback_data="toggle_notifications"
-            )],
-            [InlineKeyboardButton(f"⏱ Интервал проверки: {hours} ч", callback_data="change_interval")],
-            [InlineKeyboardButton("✅ Готово", callback_data="settings_done")]
+            [InlineKeyboardButton("Выключен", callback_data="set_digest_0")],
+            [
+                InlineKeyboardButton(f"{hours} ч", callback_data=f"set_digest_{hours}")
+                for hours in [6, 12, 24]
+            ],
+            [InlineKeyboardButton("↩️ Назад", callback_data="back_to_settings")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text("⚙️ Настройки:", reply_markup=reply_markup)
+        await query.edit_message_text(
+            "📬 Дайджест собирает новые вакансии за несколько проверок и присылает их одним сообщением.\n"
+            f"Если накопится {DIGEST_MAX_VACANCIES} вакансий, дайджест придет раньше.\n\n"
+            "Выберите, как часто присылать дайджест:",
+            reply_markup=reply_markup
+        )
     
-    elif query.data == "back_to_settings":
-        notification_status = "включены" if user_data[str(user_id)]["notification_enabled"] else "выключены"
-        check_interval_hours = user_data[str(user_id)]["check_interval"] // 3600
+    elif query.data.startswith("set_digest_"):
+        hours = int(query.data[11:])  # Отрезаем "set_digest_"
+        user_data[str(user_id)]["digest_interval"] = hours * 3600
+        save_data(user_id)
         
-        keyboard = [
-            [InlineKeyboardButton(
-                f"{'🔔' if user_data[str(user_id)]['notification_enabled'] else '🔕'} Уведомления: {notification_status}",
-                callback_data="toggle_notifications"
-            )],
-            [InlineKeyboardButton(f"⏱ Интервал проверки: {check_interval_hours} ч", callback_data="change_interval")],
-            [InlineKeyboardButton("✅ Готово", callback_data="settings_done")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text("⚙️ Настройки:", reply_markup=reply_markup)
+        await query.edit_message_text("⚙️ Настройки:", reply_markup=settings_keyboard(user_data[str(user_id)]))
+    
+    elif query.data == "back_to_settings":
+        await query.edit_message_text("⚙️ Настройки:", reply_markup=settings_keyboard(user_data[str(user_id)]))
     
     elif query.data == "settings_done":
         await query.edit_message_text("✅ Настройки сохранены!")
 
-def fetch_vacancies(keyword):
-    """Получение вакансий с hh.ru API"""
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Журналирование ошибок обработчиков и сообщение пользователю о неудаче"""
+    logger.error(f"Ошибка при обработке обновления: {context.error}", exc_info=context.error)
+    if isinstance(update, Update) and update.effective_message:
+        await update.effective_message.reply_text("⚠️ Не удалось выполнить команду, изменения могли не сохраниться. Попробуйте позже.")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработчик команды /profile (только для администраторов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    if len(context.args) != 2 or context.args[0] not in ("check", "handler") or not context.args[1].isdigit():
+        await update.message.reply_text(
+            "Использование: /profile check N - профилировать N ближайших циклов проверки\n"
+            "/profile handler N - профилировать N ближайших команд\n\n"
+            f"Осталось: циклов проверки {profiler.remaining['check']}, команд {profiler.remaining['handler']}\n"
+            f"Результаты сохраняются в {PROFILE_DIR}"
+        )
+        return
+    
+    profiler.arm(context.args[0], int(context.args[1]))
+    await update.message.reply_text(f"✅ Профилирование включено: {context.args[0]} × {context.args[1]}")
+
+class TokenBucket:
+    """Ведро токенов для ограничения частоты отправки"""
+    
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+    
+    def delay(self):
+        """Сколько секунд ждать до появления токена (без его расходования)"""
+        now = self.refill()
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+    
+    async def acquire(self):
+        """Ожидание и расходование токена (очередь ожидающих уходит в долг)"""
+        now = self.refill()
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        wait = max(wait, self.paused_until - now)
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class AdaptiveRateLimiter(TokenBucket):
+    """Ограничитель частоты запросов: снижает скорость при 429 и постепенно восстанавливает ее"""
+    
+    def __init__(self, max_rate):
+        super().__init__(max_rate, capacity=max(max_rate, 1))
+        self.max_rate = max_rate
+    
+    def throttle(self, retry_after):
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.pause(retry_after)
+        logger.warning(f"hh.ru ограничил частоту запросов: пауза {retry_after} с, скорость {self.rate:.2f} запр/с")
+    
+    def recover(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    """Предохранитель: приостанавливает запросы после серии ошибок
+    
+    После паузы пропускается один пробный запрос: при успехе предохранитель
+    замыкается, при ошибке пауза начинается заново.
+    """
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def retry_in(self):
+        """Сколько секунд осталось до пробного запроса"""
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0)
+    
+    def is_open(self):
+        return self.opened_at is not None and (self.retry_in() > 0 or self.probing)
+    
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.retry_in() > 0 or self.probing:
+            return False
+        self.probing = True
+        return True
+    
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("hh.ru снова доступен, предохранитель замкнут")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            if not self.probing:
+                logger.warning(f"hh.ru недоступен ({self.failures} ошибок подряд), запросы приостановлены на {self.cooldown} с")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+class HhApiError(Exception):
+    """Ошибка запроса к hh.ru (в отличие от пустого результата поиска)"""
+
+hh_limiter = AdaptiveRateLimiter(HH_RPS)
+hh_breaker = CircuitBreaker(HH_BREAKER_THRESHOLD, HH_BREAKER_COOLDOWN)
+
+def parse_retry_after(value):
+    """Пауза из заголовка Retry-After (в секундах)"""
     try:
-        url = "https://api.hh.ru/vacancies"
-        params = {
-            "text": keyword,  # Теперь передаем строку с оператором NAME
-            "schedule": "remote",  # Удаленная работа
-            "per_page": 100,       # Максимальное количество вакансий на страницу
-            "order_by": "publication_time"  # Сортировка по дате публикации
-        }
-        
-        headers = {
-            "User-Agent": "JobSearchTelegramBot/1.0"
-        }
+        return max(float(value), 1)
+    except (TypeError, ValueError):
+        return HH_RETRY_AFTER
+
+async def hh_get(path, params=None):
+    """Запрос к hh.ru через общий ограничитель частоты и предохранитель"""
+    if not hh_breaker.allow():
+        raise HhApiError(f"запросы к hh.ru приостановлены еще на {hh_breaker.retry_in():.0f} с")
+    
+    await hh_limiter.acquire()
+    try:
+        # Ограничиваем число одновременных запросов, чтобы не перегружать пул и API
+        async with hh_semaphore:
+            with HH_REQUEST_SECONDS.time():
+                response = await get_http_client().get(path, params=params)
+    except httpx.HTTPError as e:
+        HH_REQUESTS.labels(status="error").inc()
+        hh_breaker.record_failure()
+        raise HhApiError(f"сетевая ошибка: {e!r}") from e
+    
+    HH_REQUESTS.labels(status=str(response.status_code)).inc()
+    
+    if response.status_code >= 500:
+        hh_breaker.record_failure()
+        raise HhApiError(f"hh.ru вернул {response.status_code}")
+    if response.status_code < 400:
+        # Страница проверки на робота или обрезанный ответ приходят с кодом 200, но API не работает
+        try:
+            data = response.json()
+        except ValueError as e:
+            hh_breaker.record_failure()
+            raise HhApiError(f"hh.ru вернул ответ не в формате JSON: {response.text[:200]!r}") from e
+    
+    # Любой ответ, кроме 5xx и не разобранного 2xx, означает, что API работает
+    hh_breaker.record_success()
+    if response.status_code == 429:
+        hh_limiter.throttle(parse_retry_after(response.headers.get("Retry-After")))
+        raise HhApiError("превышен лимит запросов к hh.ru")
+    if response.status_code >= 400:
+        raise HhApiError(f"hh.ru вернул {response.status_code}: {response.text[:200]}")
+    
+    hh_limiter.recover()
+    return data
+
+def get_http_client():
+    """Получение общего асинхронного HTTP-клиента (создается при первом обращении)"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.AsyncClient(
+            base_url=HH_API_URL,
+            headers={"User-Agent": "JobSearchTelegramBot/1.0"},
+            timeout=httpx.Timeout(HH_READ_TIMEOUT, connect=HH_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HH_MAX_CONNECTIONS,
+                max_keepalive_connections=HH_MAX_CONNECTIONS
+            )
+        )
+    return http_client
+
+async def close_http_client() -> None:
+    """Закрытие HTTP-клиента при остановке бота"""
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+class ResponseCache:
+    """Кэш ответов hh.ru с временем жизни и LRU-вытеснением
+    
+    Одновременные одинаковые запросы объединяются: все вызывающие ждут
+    один и тот же запрос к API. Ошибки не кэшируются.
+    """
+    
+    def __init__(self, ttl, max_items):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.entries = OrderedDict()  # ключ -> (время истечения, вакансии)
+        self.size = 0
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+    
+    async def get(self, key, fetch):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                HH_CACHE_HITS.inc()
+                return entry[1]
+            self.remove(key)
         
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
+        task = self.inflight.get(key)
+        if task is not None:
+            self.hits += 1
+            HH_CACHE_COALESCED.inc()
+        else:
+            self.misses += 1
+            HH_CACHE_MISSES.inc()
+            task = asyncio.ensure_future(fetch())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.complete(key, done))
+        # Отмена одного из ожидающих не должна прерывать общий запрос
+        return await asyncio.shield(task)
+    
+    def complete(self, key, task):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.ttl <= 0:
+            return
+        items = task.result()
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, items)
+        self.size += len(items)
+        while self.size > self.max_items and self.entries:
+            self.remove(next(iter(self.entries)))
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+hh_cache = ResponseCache(HH_CACHE_TTL, HH_CACHE_MAX_ITEMS)
+
+async def fetch_vacancies(keyword, date_from=None):
+    """Получение вакансий с hh.ru API (через кэш ответов)
+    
+    Без keyword запрашиваются все удаленные вакансии (общий поток).
+    Без date_from возвращается первая страница самых свежих вакансий. С date_from
+    запрашиваются только вакансии, опубликованные после этой даты, с переходом
+    по страницам до конца выдачи. При ошибке выбрасывается HhApiError.
+    Возвращаемый список общий для всех вызывающих и не должен изменяться.
+    """
+    params = {
+        "schedule": "remote",  # Удаленная работа
+        "per_page": HH_PER_PAGE,
+        "order_by": "publication_time"  # Сортировка по дате публикации
+    }
+    if keyword:
+        params["text"] = keyword  # Теперь передаем строку с оператором NAME
+    if date_from:
+        params["date_from"] = date_from
+    
+    key = tuple(sorted(params.items()))
+    return await hh_cache.get(key, lambda: request_vacancies(keyword, params))
+
+async def request_vacancies(keyword, params):
+    """Запрос вакансий с hh.ru с переходом по страницам"""
+    keyword = keyword or "все удаленные вакансии"
+    date_from = params.get("date_from")
+    params = dict(params)
+    items = []
+    page = 0
+    try:
+        while True:
+            params["page"] = page
+            data = await hh_get("/vacancies", params)
+            # Сразу оставляем только нужные поля, полные ответы не накапливаются
+            for item in data.get("items", []):
+                try:
+                    items.append(Vacancy.from_api(item))
+                except (KeyError, TypeError, ValueError) as e:
+                    # Одна некорректная вакансия не должна лишать пользователей остальных
+                    logger.warning(f"Пропущена некорректная вакансия в ответе по запросу {keyword}: {e!r}")
+            page += 1
+            
+            if not date_from or page >= data.get("pages", 0) or page * HH_PER_PAGE >= HH_MAX_DEPTH:
+                break
+    except HhApiError as e:
+        HH_FETCHES.labels(result="error").inc()
+        logger.error(f"Ошибка при получении вакансий по запросу {keyword}: {e}")
+        raise
+    
+    HH_FETCHES.labels(result="ok").inc()
+    logger.info(f"Найдено {data.get('found', 0)} вакансий по запросу: {keyword} (страниц: {page})")
+    return items
+
+class Vacancy:
+    """Компактная запись вакансии: только поля, нужные для уведомлений"""
+    
+    __slots__ = ("id", "name", "url", "employer", "salary_from", "salary_to", "currency", "published_at")
+    
+    def __init__(self, id, name, url, employer, salary_from, salary_to, currency, published_at):
+        self.id = id
+        self.name = name
+        self.url = url
+        self.employer = employer
+        self.salary_from = salary_from
+        self.salary_to = salary_to
+        self.currency = currency
+        self.published_at = published_at
+    
+    @classmethod
+    def from_api(cls, item):
+        """Проекция элемента ответа hh.ru"""
+        salary = item.get("salary") or {}
+        employer = item.get("employer") or {}
+        return cls(
+            int(item["id"]),
+            item["name"],
+            item["alternate_url"],
+            employer.get("name") or "",
+            salary.get("from"),
+            salary.get("to"),
+            salary.get("currency"),
+            datetime.fromisoformat(item["published_at"])
+        )
+    
+    def to_json(self):
+        return [
+            self.id, self.name, self.url, self.employer,
+            self.salary_from, self.salary_to, self.currency, self.published_at.isoformat()
+        ]
+    
+    @classmethod
+    def from_json(cls, value):
+        # Словари - формат очереди ожидающих отправки из предыдущих версий
+        if isinstance(value, dict):
+            return cls.from_api(value)
+        vacancy_id, name, url, employer, salary_from, salary_to, currency, published_at = value
+        return cls(vacancy_id, name, url, employer, salary_from, salary_to, currency, datetime.fromisoformat(published_at))
+
+# Когда запрос последний раз успешно получен с hh.ru (для свежести локального индекса)
+keyword_refreshed = {}
+background_tasks = set()
+
+def index_vacancies(keyword, vacancies, complete=False):
+    """Сохранение полученных по запросу вакансий в локальный индекс
+    
+    Свежим запрос считается только после полного запроса первой страницы:
+    выборка с date_from содержит лишь новые вакансии и не заменяет ее.
+    """
+    storage.store_vacancies(vacancies, keyword)
+    if complete:
+        keyword_refreshed[keyword] = time.monotonic()
+
+def index_is_stale(keyword):
+    refreshed = keyword_refreshed.get(keyword)
+    return refreshed is None or time.monotonic() - refreshed > SEARCH_STALE_SECONDS
+
+async def refresh_keyword(keyword):
+    """Фоновое обновление локального индекса по запросу"""
+    try:
+        vacancies = await fetch_vacancies(f'NAME:"{keyword}"')
+    except HhApiError:
+        return
+    index_vacancies(keyword, vacancies, complete=True)
+
+def refresh_in_background(keyword):
+    if any(getattr(task, "keyword", None) == keyword for task in background_tasks):
+        return
+    task = asyncio.create_task(refresh_keyword(keyword))
+    task.keyword = keyword
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+class CheckScheduler:
+    """Очередь проверок пользователей: min-куча по времени следующей проверки"""
+    
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}  # Актуальное время проверки пользователя; остальные записи кучи устарели
+        self.job = None
+        self.job_due = None
+    
+    def __len__(self):
+        return len(self.due_at)
+    
+    def schedule(self, user_id, due_at):
+        self.due_at[user_id] = due_at
+        heapq.heappush(self.heap, (due_at, user_id))
+        # Периодически избавляемся от накопившихся устаревших записей
+        if len(self.heap) > 2 * len(self.due_at) + 64:
+            self.heap = [(due, uid) for uid, due in self.due_at.items()]
+            heapq.heapify(self.heap)
+    
+    def unschedule(self, user_id):
+        self.due_at.pop(user_id, None)
+    
+    def next_due(self):
+        while self.heap:
+            due_at, user_id = self.heap[0]
+            if self.due_at.get(user_id) == due_at:
+                return due_at
+            heapq.heappop(self.heap)
+        return None
+    
+    def backlog(self, now):
+        """Число пользователей, чья проверка уже просрочена"""
+        return sum(1 for due_at in list(self.due_at.values()) if due_at <= now)
+    
+    def pop_due(self, now):
+        """Извлечение всех пользователей, для которых наступило время проверки"""
+        due = []
+        while (next_due := self.next_due()) is not None and next_due <= now:
+            due_at, user_id = heapq.heappop(self.heap)
+            del self.due_at[user_id]
+            due.append((user_id, due_at))
+        return due
+
+scheduler = CheckScheduler()
+
+def next_check_time(user_id, settings, now):
+    """Время следующей проверки пользователя по его последней проверке"""
+    if settings["last_check"]:
+        due_at = datetime.fromisoformat(settings["last_check"]).timestamp() + settings["check_interval"]
+        if due_at > now:
+            return due_at
+    # Просроченные проверки распределяем по окну, чтобы они не срабатывали одновременно
+    return now + zlib.crc32(str(user_id).encode()) % max(CHECK_SPREAD, 1)
+
+def schedule_user(user_id, job_queue=None):
+    """Постановка пользователя в очередь проверок с учетом его настроек"""
+    if BOT_ROLE == "front":
+        # Проверки выполняют рабочие процессы, они узнают о новых настройках при синхронизации
+        return
+    data = get_user(user_id)
+    if data is not None and data["notification_enabled"]:
+        scheduler.schedule(str(user_id), next_check_time(user_id, data, time.time()))
+    else:
+        scheduler.unschedule(str(user_id))
+    if job_queue is not None:
+        arm_scheduler(job_queue)
+
+def load_schedule():
+    """Заполнение очереди проверок при запуске"""
+    now = time.time()
+    for user_id, settings in storage.iter_user_settings():
+        if settings["notification_enabled"]:
+            scheduler.schedule(user_id, next_check_time(user_id, settings, now))
+    logger.info(f"Запланированы проверки для {len(scheduler)} пользователей")
+
+def arm_scheduler(job_queue, first=None):
+    """Пробуждение к ближайшей запланированной проверке (без периодического опроса)"""
+    next_due = scheduler.next_due()
+    if next_due is None:
+        return
+    if first is not None:
+        next_due = max(next_due, time.time() + first)
+    if scheduler.job is not None and not scheduler.job.removed and scheduler.job_due <= next_due:
+        return
+    if scheduler.job is not None:
+        scheduler.job.schedule_removal()
+    scheduler.job = job_queue.run_once(check_new_vacancies, when=max(next_due - time.time(), 0))
+    scheduler.job_due = next_due
+
+class HashRing:
+    """Кольцо консистентного хеширования: распределение пользователей по рабочим процессам
+    
+    При добавлении или остановке процесса меняется владелец только у части пользователей.
+    """
+    
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.points = sorted((ring_hash(f"{node}#{index}"), node) for node in nodes for index in range(replicas))
+        self.hashes = [point[0] for point in self.points]
+    
+    def owner(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+# Пользователи, арендованные рабочим процессом (None - процесс обслуживает всех)
+owned_users = None
+shard_workers = []
+
+# Число выполняющихся циклов проверки: пока цикл идет, процесс не отпускает своих пользователей
+running_cycles = 0
+
+@contextmanager
+def cycle_running():
+    global running_cycles
+    running_cycles += 1
+    try:
+        yield
+    finally:
+        running_cycles -= 1
+
+def owns_user(user_id):
+    return owned_users is None or str(user_id) in owned_users
+
+async def sync_shard(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Синхронизация рабочего процесса через общее хранилище
+    
+    Процесс отмечается как работающий, по кольцу работающих процессов выбирает
+    своих пользователей и арендует их. Пользователь обслуживается только процессом,
+    который держит его аренду, поэтому при перестройке кольца уведомления не дублируются:
+    новый владелец получает пользователя после того, как прежний освободит аренду
+    или она истечет. Настройки пользователей (их меняет процесс front) обновляются здесь же.
+    """
+    global owned_users, shard_workers
+    now = time.time()
+    workers = storage.heartbeat(WORKER_ID, now, WORKER_TTL)
+    ring = HashRing(workers)
+    user_settings = dict(storage.iter_user_settings())
+    wanted = {user_id for user_id in user_settings if ring.owner(user_id) == WORKER_ID}
+    if running_cycles and owned_users:
+        # Новые вакансии пользователей, которые раздаются в текущем цикле, еще не сохранены:
+        # аренда продлевается, а освобождены они будут при первой синхронизации после цикла
+        wanted |= owned_users & user_settings.keys()
+    claimed = storage.claim_users(WORKER_ID, list(wanted), now, WORKER_TTL)
+    
+    if workers != shard_workers:
+        logger.info(f"Рабочие процессы: {', '.join(workers)}")
+        shard_workers = workers
+        # Общие лимиты Telegram и hh.ru делятся между процессами поровну
+        delivery.global_bucket.rate = delivery.global_bucket.capacity = TG_GLOBAL_RATE / len(workers)
+        hh_limiter.max_rate = HH_RPS / len(workers)
+        hh_limiter.rate = min(hh_limiter.rate, hh_limiter.max_rate)
+    
+    previous = owned_users if owned_users is not None else set()
+    if claimed != previous:
+        logger.info(f"Процесс {WORKER_ID}: {len(claimed)} пользователей (+{len(claimed - previous)}, -{len(previous - claimed)})")
+    
+    # Ушедшие пользователи: циклов проверки нет, поэтому их состояние уже сохранено;
+    # неотправленные сообщения остаются в хранилище
+    for user_id in previous - claimed:
+        user_data.pop(user_id, None)
+        scheduler.unschedule(user_id)
+        delivery.forget(int(user_id))
+    
+    index_changed = claimed != previous
+    for user_id in claimed:
+        settings = user_settings[user_id]
+        if user_id not in previous:
+            user_data.pop(user_id, None)
+            delivery.restore(int(user_id))
+            if settings["notification_enabled"]:
+                scheduler.schedule(user_id, next_check_time(user_id, settings, now))
+            continue
         
-        data = response.json()
-        logger.info(f"Найдено {data.get('found', 0)} вакансий по запросу: {keyword}")
-        return data.get("items", [])
+        data = get_user(user_id)
+        if data is None:
+            continue
+        reschedule = (
+            data["notification_enabled"] != settings["notification_enabled"]
+            or data["check_interval"] != settings["check_interval"]
+        )
+        index_changed = index_changed or data["keywords"] != settings["keywords"]
+        data["keywords"] = settings["keywords"]
+        data["exclude_words"] = settings["exclude_words"]
+        data["notification_enabled"] = settings["notification_enabled"]
+        data["check_interval"] = settings["check_interval"]
+        data["digest_interval"] = settings["digest_interval"]
+        if reschedule:
+            schedule_user(user_id)
     
-    except Exception as e:
-        logger.error(f"Ошибка при получении вакансий: {e}")
-        return []
+    owned_users = claimed
+    if index_changed:
+        rebuild_keyword_index({user_id: user_settings[user_id] for user_id in claimed})
+    arm_scheduler(context.job_queue)
+
+async def fetch_keyword(keyword):
+    """Получение новых вакансий по запросу в рамках цикла проверки (None при ошибке)"""
+    async with check_semaphore:
+        try:
+            return await fetch_vacancies(f'NAME:"{keyword}"', watermark_date_from(keyword))
+        except HhApiError:
+            return None
 
 async def check_new_vacancies(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Проверка новых вакансий и отправка уведомлений"""
     now = datetime.now()
+    scheduler.job = None
     
-    for user_id, data in user_data.items():
+    # Пока hh.ru недоступен, проверки откладываются: пользователи остаются в очереди
+    if hh_breaker.is_open():
+        retry_in = max(hh_breaker.retry_in(), 1)
+        logger.warning(f"hh.ru недоступен, проверка отложена на {retry_in:.0f} с")
+        scheduler.job = context.job_queue.run_once(check_new_vacancies, when=retry_in)
+        scheduler.job_due = time.time() + retry_in
+        return
+    
+    # Забираем из очереди пользователей, для которых пора выполнять проверку,
+    # и сразу планируем их следующую проверку ровно через их интервал
+    due_users = []
+    for user_id, due_at in scheduler.pop_due(now.timestamp()):
+        data = get_user(user_id)
         # Проверяем, включены ли уведомления
-        if not data["notification_enabled"]:
+        if data is None or not data["notification_enabled"]:
             continue
         
-        # Проверяем, пора ли выполнять проверку
-        if data["last_check"]:
-            last_check = datetime.fromisoformat(data["last_check"])
-            next_check = last_check + timedelta(seconds=data["check_interval"])
-            
-            if now < next_check:
-                continue
+        next_due = due_at + data["check_interval"]
+        if next_due <= now.timestamp():
+            next_due = now.timestamp() + data["check_interval"]
+        scheduler.schedule(user_id, next_due)
         
         # Пропускаем пользователей без ключевых слов
         if not data["keywords"]:
             continue
         
-        logger.info(f"Проверка новых вакансий для пользователя {user_id}")
-        
-        # Получаем вакансии для каждого ключевого слова
-        all_vacancies = []
-        for keyword in data["keywords"]:
-            vacancies = fetch_vacancies(f'NAME:"{keyword}"')
-            if vacancies:
-                all_vacancies.extend(vacancies)
+        due_users.append(user_id)
+    
+    arm_scheduler(context.job_queue)
+    
+    if not due_users:
+        return
+    
+    with profiler.profile("check", "check_cycle"), cycle_running():
+        await run_check_cycle(due_users, now)
+
+async def run_check_cycle(due_users, now):
+    """Получение новых вакансий для пользователей, чья проверка наступила, и раздача уведомлений"""
+    started = time.perf_counter()
+    
+    # Каждое уникальное ключевое слово запрашиваем один раз за цикл и только начиная с его отметки.
+    # В режиме общего потока вакансии уже распределены при получении потока.
+    due_set = set(due_users)
+    if INGEST_MODE == "firehose":
+        due_keywords = []
+    else:
+        due_keywords = [keyword for keyword, subscribers in keyword_index.items() if subscribers & due_set]
+    logger.info(f"Проверка новых вакансий: {len(due_users)} пользователей, {len(due_keywords)} уникальных запросов")
+    
+    with CHECK_STAGE_SECONDS.labels(stage="fetch").time():
+        results = await asyncio.gather(*(fetch_keyword(keyword) for keyword in due_keywords))
+    
+    with CHECK_STAGE_SECONDS.labels(stage="enrich").time():
+        details = await enrich_vacancies(vacancies_to_enrich(zip(due_keywords, results)))
+    
+    # Обработка идет порциями с передачей управления циклу событий между ними,
+    # чтобы команды пользователей и отправка уведомлений не ждали весь цикл
+    with CHECK_STAGE_SECONDS.labels(stage="process").time():
+        # Запросы с ошибкой пропускаются: их отметка не сдвигается, и вакансии будут получены в следующий раз
+        fetched = [(keyword, vacancies) for keyword, vacancies in zip(due_keywords, results) if vacancies is not None]
+        for keyword, vacancies in fetched:
+            with storage.batch():
+                index_vacancies(keyword, vacancies)
+            await asyncio.sleep(0)
         
-        # Удаляем дубликаты
-        unique_vacancies = []
-        vacancy_ids = set()
-        for vacancy in all_vacancies:
-            if vacancy["id"] not in vacancy_ids:
-                unique_vacancies.append(vacancy)
-                vacancy_ids.add(vacancy["id"])
+        changed_users = await fan_out(fetched, details)
         
-        # Сортируем по дате публикации (самые свежие вначале)
-        unique_vacancies.sort(key=lambda x: x["published_at"], reverse=True)
+        # Пользователям, для которых пора выполнять проверку, отправляем накопленные вакансии
+        flush_users = set(due_users)
+        await save_users(due_users + [user_id for user_id in changed_users if user_id not in flush_users], flush_users, now)
         
-        # Находим новые вакансии
-        new_vacancies = []
-        for vacancy in unique_vacancies:
-            if vacancy["id"] not in data["last_vacancies"]:
-                new_vacancies.append(vacancy)
+        # Отметки сдвигаются только после сохранения всех пользователей: при сбое
+        # вакансии будут получены повторно, а повторы отсечет множество показанных
+        with storage.batch():
+            for keyword, vacancies in fetched:
+                if vacancies:
+                    advance_watermark(keyword, vacancies)
+            storage.prune_vacancies(datetime.now(timezone.utc) - timedelta(days=VACANCY_TTL_DAYS))
+    
+    CHECK_CYCLE_SECONDS.observe(time.perf_counter() - started)
+
+def watermark_date_from(key):
+    """Начало выборки для запроса: отметка минус окно перекрытия
+    
+    Вакансии появляются в выдаче hh.ru с задержкой индексации, поэтому опубликованные
+    незадолго до отметки запрашиваются повторно; уже показанные отсеиваются по seen.
+    """
+    watermark = keyword_watermarks.get(key)
+    if not watermark:
+        return None
+    return (datetime.fromisoformat(watermark) - timedelta(seconds=WATERMARK_OVERLAP)).isoformat()
+
+def advance_watermark(key, vacancies):
+    """Сдвиг отметки запроса на самую свежую полученную вакансию (только вперед)"""
+    latest = max(vacancy.published_at for vacancy in vacancies)
+    current = keyword_watermarks.get(key)
+    if current and datetime.fromisoformat(current) >= latest:
+        return
+    watermark = latest.isoformat()
+    keyword_watermarks[key] = watermark
+    storage.save_watermark(key, watermark)
+
+def chunked(items, size):
+    """Разбиение последовательности на части не больше size"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+async def fan_out(matches, details=None):
+    """Раздача вакансий подписчикам запросов порциями по CHECK_BATCH_SIZE пользователей"""
+    changed_users = set()
+    merged_users = set()
+    for keyword, vacancies in matches:
+        if not vacancies:
+            continue
+        for user_ids in chunked(keyword_index.get(keyword, ()), CHECK_BATCH_SIZE):
+            if BOT_ROLE == "worker":
+                # Вакансии, показанные в /search процессом front, не должны прийти уведомлением
+                refresh_seen(user_ids, merged_users)
+            distribute_vacancies(keyword, vacancies, changed_users, details, user_ids)
+            # Загруженные, но не получившие вакансий (например, с выключенными уведомлениями)
+            # не попадут в save_users, поэтому выгружаем их здесь
+            evict_idle_users([user_id for user_id in user_ids if user_id not in changed_users])
+            await asyncio.sleep(0)
+    return changed_users
+
+def refresh_seen(user_ids, merged_users):
+    """Однократное за цикл объединение показанных вакансий с сохраненной копией"""
+    for user_id in user_ids:
+        if user_id in merged_users or not owns_user(user_id) or get_user(user_id) is None:
+            continue
+        merge_stored_seen(user_id)
+        merged_users.add(user_id)
+
+async def save_users(user_ids, flush_users=(), now=None):
+    """Сохранение пользователей порциями, каждая порция - отдельная транзакция
+    
+    Пользователям из flush_users накопленные вакансии ставятся в очередь отправки
+    в той же транзакции, что и сохранение.
+    """
+    rendered = {}  # Блоки вакансий этого цикла, общие для всех получателей
+    # JSON-хранилище переписывает файл пользователей целиком при каждой записи,
+    # поэтому для него все порции записываются один раз в конце
+    with storage.batch() if STORAGE_BACKEND == "json" else nullcontext():
+        for chunk in chunked(user_ids, CHECK_BATCH_SIZE):
+            with storage.batch():
+                for user_id in chunk:
+                    # Пользователь мог перейти к другому процессу, пока выполнялись запросы
+                    if user_id in flush_users and owns_user(user_id):
+                        logger.info(f"Проверка новых вакансий для пользователя {user_id}")
+                        flush_pending(user_id, now, rendered)
+                save_changed_users(chunk)
+            evict_idle_users(chunk)
+            await asyncio.sleep(0)
+
+def evict_idle_users(user_ids):
+    """Выгрузка из памяти уже сохраненных пользователей, давно не вызывавших команды"""
+    # JSON-хранилище само держит всех пользователей в памяти, выгрузка ничего не дает
+    if STORAGE_BACKEND != "sqlite":
+        return
+    
+    cutoff = time.monotonic() - USER_CACHE_IDLE
+    for user_id in user_ids:
+        last_active = user_activity.get(user_id)
+        if last_active is not None and last_active >= cutoff:
+            continue
+        user_activity.pop(user_id, None)
+        user_data.pop(user_id, None)
+
+def distribute_vacancies(keyword, vacancies, changed_users, details=None, user_ids=None):
+    """Раздача свежих вакансий подписчикам запроса (всем или только user_ids)
+    
+    У каждого подписчика свое состояние просмотренных. Подписчики, для которых
+    проверка еще не наступила, получат вакансии в свою очередь. Вакансии
+    с исключенными пользователем словами отмечаются просмотренными без отправки.
+    """
+    for user_id in user_ids if user_ids is not None else keyword_index.get(keyword, set()):
+        if not owns_user(user_id):
+            continue
+        data = get_user(user_id)
+        if data is None or not data["notification_enabled"]:
+            continue
         
-        # Обновляем данные пользователя
-        user_data[user_id]["last_vacancies"] = [v["id"] for v in unique_vacancies]
-        user_data[user_id]["last_check"] = now.isoformat()
-        save_data()
+        seen = get_seen(user_id)
+        pending = data.setdefault("pending", [])
+        excluded = data.get("exclude_words")
+        added = len(pending)
+        for vacancy in vacancies:
+            if vacancy.id in seen:
+                continue
+            if not (excluded and is_excluded(vacancy, excluded, details)):
+                pending.append(vacancy)
+            seen.add(vacancy.id)
+        NEW_VACANCIES.inc(len(pending) - added)
+        changed_users.add(user_id)
+
+def flush_pending(user_id, now, rendered=None):
+    """Постановка накопленных вакансий пользователя в очередь отправки
+    
+    В режиме дайджеста вакансии копятся в очереди ожидающих между проверками
+    и отправляются, когда наступит время дайджеста или их накопится достаточно.
+    """
+    data = get_user(user_id)
+    pending = data.get("pending", [])
+    digest_interval = data.get("digest_interval", 0)
+    if digest_interval:
+        if not data.get("last_digest"):
+            # Отсчет периода дайджеста начинается с первой проверки после его включения
+            data["last_digest"] = now.isoformat()
+        digest_due = now - datetime.fromisoformat(data["last_digest"]) >= timedelta(seconds=digest_interval)
+        if digest_due or len(pending) >= DIGEST_MAX_VACANCIES:
+            if pending:
+                pending.sort(key=lambda x: x.published_at, reverse=True)
+                for text in build_digest_messages(pending[:PENDING_MAX_SIZE]):
+                    delivery.enqueue(int(user_id), text, "HTML")
+                data["pending"] = []
+            data["last_digest"] = now.isoformat()
+    else:
+        if pending:
+            # Сортируем по дате публикации (самые свежие вначале) и ставим в очередь отправки
+            pending.sort(key=lambda x: x.published_at, reverse=True)
+            for text, parse_mode in build_notification_messages(pending[:PENDING_MAX_SIZE], rendered):
+                delivery.enqueue(int(user_id), text, parse_mode)
+        data["pending"] = []
+        data.pop("last_digest", None)
+    get_seen(user_id).evict()
+    data["last_check"] = now.isoformat()
+
+def save_changed_users(changed_users):
+    """Сохранение измененных пользователей с ограничением очереди ожидающих отправки"""
+    for user_id in changed_users:
+        # Пользователь мог перейти к другому процессу и быть выгружен
+        if user_id not in user_data:
+            continue
+        # Ограничиваем очередь ожидающих отправки, оставляя самые свежие
+        pending = user_data[user_id]["pending"]
+        pending.sort(key=lambda x: x.published_at, reverse=True)
+        del pending[PENDING_MAX_SIZE:]
+        save_data(user_id)
+
+async def ingest_firehose(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Получение общего потока новых удаленных вакансий и локальное сопоставление с ключевыми словами"""
+    if hh_breaker.is_open():
+        logger.warning("hh.ru недоступен, получение потока вакансий пропущено")
+        return
+    
+    with profiler.profile("check", "firehose"), cycle_running():
+        await run_firehose_cycle()
+
+async def run_firehose_cycle():
+    """Один цикл получения и распределения общего потока вакансий"""
+    started = time.perf_counter()
+    try:
+        with CHECK_STAGE_SECONDS.labels(stage="firehose_fetch").time():
+            vacancies = await fetch_vacancies(None, watermark_date_from(FIREHOSE_KEY))
+    except HhApiError:
+        return
+    if not vacancies:
+        return
+    
+    # Один проход автомата по названию находит все подписанные фразы сразу.
+    # Разделители не учитываются: "Python-разработчик" соответствует "python разработчик",
+    # но "C#" не соответствует "c++" и "c".
+    matches = {}
+    for vacancy in vacancies:
+        for pattern in keyword_matcher.find(match_text(vacancy.name)):
+            for keyword in keyword_patterns[pattern]:
+                matches.setdefault(keyword, []).append(vacancy)
+    
+    with CHECK_STAGE_SECONDS.labels(stage="enrich").time():
+        details = await enrich_vacancies(vacancies_to_enrich(matches.items()))
+    
+    with CHECK_STAGE_SECONDS.labels(stage="firehose_process").time():
+        with storage.batch():
+            storage.store_vacancies(vacancies)
+            for keyword, matched in matches.items():
+                storage.link_vacancies(keyword, matched)
+            storage.prune_vacancies(datetime.now(timezone.utc) - timedelta(days=VACANCY_TTL_DAYS))
         
-        # Отправляем уведомления о новых вакансиях
-        if new_vacancies:
+        changed_users = await fan_out(matches.items(), details)
+        await save_users(list(changed_users))
+        with storage.batch():
+            advance_watermark(FIREHOSE_KEY, vacancies)
+    
+    logger.info(
+        f"Поток вакансий: получено {len(vacancies)}, совпадений с {len(matches)} запросами, "
+        f"затронуто {len(changed_users)} пользователей"
+    )
+    CHECK_CYCLE_SECONDS.observe(time.perf_counter() - started)
+
+def is_excluded(vacancy, excluded, details=None):
+    """Есть ли в названии или сохраненном тексте вакансии исключенные пользователем слова
+    
+    Слова сравниваются после match_text, как и ключевые фразы потока:
+    
+    >>> vacancy = Vacancy(1, "Senior C# developer", "", "", None, None, None, None)
+    >>> is_excluded(vacancy, [match_text("c++")]), is_excluded(vacancy, [match_text("C#")])
+    (False, True)
+    """
+    text = f" {match_text(vacancy.name)} {match_text(details.get(vacancy.id, '')) if details else ''} "
+    return any(f" {word} " in text for word in excluded)
+
+def vacancy_text(detail):
+    """Текст вакансии для сопоставления: описание без разметки и ключевые навыки"""
+    description = html.unescape(re.sub(r"<[^>]+>", " ", detail.get("description") or ""))
+    skills = " ".join(skill["name"] for skill in detail.get("key_skills") or [])
+    return f"{description} {skills}"
+
+def vacancies_to_enrich(results):
+    """Вакансии, для которых нужен полный текст: у запроса есть подписчики с исключенными словами"""
+    if detail_cache is None:
+        return []
+    vacancies = []
+    for keyword, found in results:
+        if found and any(
+            owns_user(user_id) and (get_user(user_id) or {}).get("exclude_words") for user_id in keyword_index.get(keyword, ())
+        ):
+            vacancies.extend(found)
+    return vacancies
+
+async def fetch_detail(vacancy_id, semaphore):
+    async with semaphore:
+        try:
+            return vacancy_id, vacancy_text(await hh_get(f"/vacancies/{vacancy_id}"))
+        except HhApiError as e:
+            logger.warning(f"Не удалось получить текст вакансии {vacancy_id}: {e}")
+            return vacancy_id, None
+
+async def enrich_vacancies(vacancies):
+    """Тексты вакансий из кэша; недостающие запрашиваются с hh.ru один раз на вакансию
+    
+    Число запросов зависит только от числа новых уникальных вакансий, а не от числа
+    подписчиков: полученный текст используется всеми пользователями и следующими проверками.
+    """
+    if detail_cache is None or not vacancies:
+        return {}
+    
+    vacancy_ids = {vacancy.id for vacancy in vacancies}
+    details = detail_cache.get_many(vacancy_ids)
+    missing = vacancy_ids - details.keys()
+    DETAIL_CACHE_HITS.inc(len(details))
+    DETAIL_CACHE_MISSES.inc(len(missing))
+    if missing:
+        semaphore = asyncio.Semaphore(DETAIL_CONCURRENCY)
+        results = await asyncio.gather(*(fetch_detail(vacancy_id, semaphore) for vacancy_id in missing))
+        # Ошибки не кэшируются: такие вакансии сравниваются только по названию
+        fetched = {vacancy_id: text for vacancy_id, text in results if text is not None}
+        detail_cache.put_many(fetched)
+        details.update(fetched)
+    return details
+
+def format_salary(vacancy):
+    """Текстовое описание зарплаты"""
+    from_salary = vacancy.salary_from if vacancy.salary_from else ""
+    to_salary = vacancy.salary_to if vacancy.salary_to else ""
+    currency = vacancy.currency if vacancy.currency else ""
+    
+    if from_salary and to_salary:
+        return f"{from_salary} - {to_salary} {currency}"
+    elif from_salary:
+        return f"от {from_salary} {currency}"
+    elif to_salary:
+        return f"до {to_salary} {currency}"
+    return "Зарплата не указана"
+
+# Готовые HTML-блоки вакансий для /search: ID вакансии -> текст (LRU)
+render_cache = OrderedDict()
+
+def render_vacancy(vacancy):
+    """HTML-блок вакансии для сообщения"""
+    return "".join((
+        f'<a href="{html.escape(vacancy.url)}">{html.escape(vacancy.name)}</a>\n',
+        f"🏢 {html.escape(vacancy.employer)}\n",
+        f"💰 {html.escape(format_salary(vacancy))}\n",
+        f"📅 {vacancy.published_at.strftime('%d.%m.%Y %H:%M')}\n\n"
+    ))
+
+def render_vacancies(vacancies, rendered=None):
+    """HTML-блоки вакансий (каждый формируется один раз для всех получателей)
+    
+    rendered - блоки текущего цикла проверки. Он живет до конца цикла и ничего
+    не вытесняет, поэтому не зависит от того, сколько разных вакансий в цикле.
+    Без него используется LRU-кэш render_cache.
+    """
+    cache = render_cache if rendered is None else rendered
+    blocks = []
+    hits = 0
+    for vacancy in vacancies:
+        block = cache.get(vacancy.id)
+        if block is None:
+            block = cache[vacancy.id] = render_vacancy(vacancy)
+        else:
+            hits += 1
+            if rendered is None:
+                render_cache.move_to_end(vacancy.id)
+        blocks.append(block)
+    if rendered is None:
+        while len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
+    
+    RENDER_CACHE_HITS.inc(hits)
+    RENDER_CACHE_MISSES.inc(len(blocks) - hits)
+    return blocks
+
+def pack_messages(blocks, limit=MESSAGE_LIMIT):
+    """Упаковка блоков в сообщения не длиннее лимита Telegram"""
+    messages = []
+    current = []
+    length = 0
+    for block in blocks:
+        if current and length + len(block) > limit:
+            messages.append("".join(current))
+            current = []
+            length = 0
+        current.append(block)
+        length += len(block)
+    if current:
+        messages.append("".join(current))
+    return messages
+
+def build_notification_messages(new_vacancies, rendered=None):
+    """Сообщения с уведомлением о новых вакансиях"""
+    messages = [(f"🔔 Найдено {len(new_vacancies)} новых вакансий по вашим запросам!", None)]
+    for message in pack_messages(render_vacancies(new_vacancies, rendered)):
+        messages.append((message, "HTML"))
+    return messages
+
+def render_digest_line(vacancy):
+    """Короткая строка вакансии для дайджеста"""
+    return (
+        f'• <a href="{html.escape(vacancy.url)}">{html.escape(vacancy.name)}</a> — '
+        f"{html.escape(vacancy.employer)}, {html.escape(format_salary(vacancy))}\n"
+    )
+
+def build_digest_messages(vacancies):
+    """Дайджест: заголовок и короткие строки вакансий в как можно меньшем числе сообщений"""
+    header = f"📬 Дайджест: {len(vacancies)} новых вакансий по вашим запросам\n\n"
+    lines = (render_digest_line(vacancy) for vacancy in vacancies)
+    return pack_messages([header, *lines])
+
+class DeliveryQueue:
+    """Очередь исходящих уведомлений с ограничением скорости и повторными попытками
+    
+    Сообщения сохраняются в хранилище до успешной отправки; в памяти хранятся только
+    их идентификаторы, текст читается из хранилища перед отправкой. Сообщения одного
+    чата отправляются по порядку, разные чаты обслуживаются параллельно.
+    """
+    
+    def __init__(self):
+        self.chats = {}  # chat_id -> очередь сообщений [id, попытки]
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, capacity=TG_GLOBAL_RATE)
+        self.ready = None
+        self.bot = None
+        self.workers = []
+    
+    def __len__(self):
+        return sum(len(queue) for queue in list(self.chats.values()))
+    
+    def enqueue(self, chat_id, text, parse_mode=None):
+        """Добавление сообщения в очередь (с сохранением в хранилище)"""
+        self.push(chat_id, storage.add_outbox(chat_id, text, parse_mode))
+    
+    def push(self, chat_id, message_id):
+        """Постановка в очередь сообщения, уже сохраненного в хранилище"""
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = deque()
+            if self.ready is not None:
+                self.ready.put_nowait(chat_id)
+        queue.append([message_id, 0])
+    
+    def start(self, bot, restore=True):
+        """Загрузка неотправленных сообщений и запуск отправителей"""
+        self.bot = bot
+        if restore:
+            for message_id, chat_id in storage.load_outbox():
+                self.push(chat_id, message_id)
+        self.ready = asyncio.Queue()
+        for chat_id in self.chats:
+            self.ready.put_nowait(chat_id)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(DELIVERY_WORKERS)]
+        logger.info(f"Очередь уведомлений запущена, неотправленных сообщений: {len(self)}")
+    
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    
+    def restore(self, chat_id):
+        """Загрузка неотправленных сообщений чата, перешедшего к этому процессу"""
+        if chat_id in self.chats:
+            return
+        for message_id in storage.load_chat_outbox(chat_id):
+            self.push(chat_id, message_id)
+    
+    def forget(self, chat_id):
+        """Отказ от сообщений чата, перешедшего к другому процессу (они остаются в хранилище)"""
+        self.chats.pop(chat_id, None)
+        self.chat_buckets.pop(chat_id, None)
+    
+    def release(self, chat_id, delay=0):
+        """Возврат чата в очередь готовых (или удаление, если сообщений не осталось)"""
+        if not self.chats.get(chat_id):
+            self.chats.pop(chat_id, None)
+            return
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, chat_id)
+        else:
+            self.ready.put_nowait(chat_id)
+    
+    def drop(self, chat_id, message):
+        """Удаление сообщения из головы очереди чата и из хранилища"""
+        queue = self.chats.get(chat_id)
+        if queue and queue[0] is message:
+            queue.popleft()
+        storage.delete_outbox(message[0])
+    
+    async def worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            if not self.chats.get(chat_id):
+                continue
+            chat_bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(TG_CHAT_RATE))
+            wait = max(chat_bucket.delay(), self.global_bucket.paused_until - time.monotonic())
+            if wait > 0:
+                self.release(chat_id, wait)
+                continue
+            
+            await self.global_bucket.acquire()
+            await chat_bucket.acquire()
+            if not self.chats.get(chat_id):
+                continue
+            message = self.chats[chat_id][0]
+            stored = storage.load_outbox_message(message[0])
+            if stored is None:
+                # Сообщение уже удалено из хранилища (например, другим процессом)
+                self.drop(chat_id, message)
+                self.release(chat_id)
+                continue
+            
+            text, parse_mode = stored
+            delay = 0
             try:
-                await context.bot.send_message(
-                    chat_id=int(user_id),
-                    text=f"🔔 Найдено {len(new_vacancies)} новых вакансий по вашим запросам!"
-                )
-                
-                # Группируем по 10 вакансий для избежания ограничений Telegram
-                chunks = [new_vacancies[i:i+10] for i in range(0, len(new_vacancies), 10)]
-                
-                for chunk in chunks:
-                    message = ""
-                    for vacancy in chunk:
-                        published_date = datetime.fromisoformat(vacancy["published_at"].replace("Z", "+00:00"))
-                        published_str = published_date.strftime("%d.%m.%Y %H:%M")
-                        
-                        salary_info = "Зарплата не указана"
-                        if vacancy["salary"]:
-                            from_salary = vacancy["salary"]["from"] if vacancy["salary"]["from"] else ""
-                            to_salary = vacancy["salary"]["to"] if vacancy["salary"]["to"] else ""
-                            currency = vacancy["salary"]["currency"] if vacancy["salary"]["currency"] else ""
-                            
-                            if from_salary and to_salary:
-                                salary_info = f"{from_salary} - {to_salary} {currency}"
-                            elif from_salary:
-                                salary_info = f"от {from_salary} {currency}"
-                            elif to_salary:
-                                salary_info = f"до {to_salary} {currency}"
-                        
-                        message += f"[{vacancy['name']}]({vacancy['alternate_url']})\n"
-                        message += f"🏢 {vacancy['employer']['name']}\n"
-                        message += f"💰 {salary_info}\n"
-                        message += f"📅 {published_str}\n\n"
-                    
-                    await context.bot.send_message(
-                        chat_id=int(user_id),
-                        text=message,
-                        parse_mode="Markdown",
+                with TELEGRAM_SEND_SECONDS.time():
+                    await self.bot.send_message(
+                        chat_id=chat_id,
+                        text=text,
+                        parse_mode=parse_mode,
                         disable_web_page_preview=True
                     )
-            
+                MESSAGES_SENT.inc()
+                self.drop(chat_id, message)
+            except RetryAfter as e:
+                SEND_FAILURES.labels(reason="retry_after").inc()
+                # Telegram просит подождать: приостанавливаем все отправки
+                logger.warning(f"Превышен лимит Telegram, пауза {e.retry_after} с")
+                self.global_bucket.pause(e.retry_after)
+                delay = e.retry_after
+            except Forbidden as e:
+                SEND_FAILURES.labels(reason="forbidden").inc()
+                # Пользователь заблокировал бота: остальные сообщения ему тоже не нужны
+                logger.warning(f"Пользователь {chat_id} недоступен: {e}")
+                while self.chats.get(chat_id):
+                    self.drop(chat_id, self.chats[chat_id][0])
+            except BadRequest as e:
+                SEND_FAILURES.labels(reason="bad_request").inc()
+                logger.error(f"Сообщение пользователю {chat_id} отклонено: {e}")
+                self.drop(chat_id, message)
             except Exception as e:
-                logger.error(f"Ошибка при отправке уведомления пользователю {user_id}: {e}")
+                SEND_FAILURES.labels(reason="error").inc()
+                message[1] += 1
+                if message[1] >= DELIVERY_MAX_ATTEMPTS:
+                    logger.error(f"Ошибка при отправке уведомления пользователю {chat_id}, сообщение удалено: {e}")
+                    self.drop(chat_id, message)
+                else:
+                    delay = min(2 ** message[1], 300)
+                    logger.warning(f"Ошибка при отправке уведомления пользователю {chat_id}, повтор через {delay} с: {e}")
+            
+            if not self.chats.get(chat_id):
+                self.chat_buckets.pop(chat_id, None)
+            self.release(chat_id, delay)
+
+delivery = DeliveryQueue()
+
+class Profiler:
+    """Профилирование ближайших N циклов проверки или вызовов команд по запросу
+    
+    Для каждого вызова сохраняются статистика cProfile (.pstats) и текстовый отчет
+    с самыми долгими функциями и крупнейшими выделениями памяти (tracemalloc).
+    Профилировщик включается на весь поток, поэтому в отчет попадают и задачи,
+    выполнявшиеся в цикле событий параллельно с профилируемой.
+    """
+    
+    def __init__(self):
+        self.remaining = {"check": PROFILE_CYCLES, "handler": PROFILE_HANDLERS}
+        self.active = False
+    
+    def arm(self, target, count):
+        self.remaining[target] = count
+    
+    @contextmanager
+    def profile(self, target, name):
+        # Одновременно работает только один профилировщик
+        if self.active or self.remaining[target] <= 0:
+            yield
+            return
+        
+        self.remaining[target] -= 1
+        self.active = True
+        tracemalloc.start()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.active = False
+            try:
+                self.write_report(f"{target}-{name}", profile, snapshot)
+            except OSError as e:
+                logger.error(f"Не удалось сохранить результаты профилирования: {e}")
+    
+    def write_report(self, name, profile, snapshot):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+        profile.dump_stats(f"{path}.pstats")
+        with open(f"{path}.txt", 'w', encoding='utf-8') as file:
+            pstats.Stats(profile, stream=file).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            file.write("Крупнейшие выделения памяти:\n")
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                file.write(f"{stat}\n")
+        logger.info(f"Результаты профилирования сохранены: {path}.pstats, {path}.txt")
+
+profiler = Profiler()
+
+def profiled(handler):
+    """Обертка обработчика команды для профилирования по запросу"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        with profiler.profile("handler", handler.__name__):
+            await handler(update, context)
+    return wrapper
+
+class LoopStallDetector:
+    """Обнаружение блокировок цикла событий
+    
+    Задача в цикле событий регулярно обновляет отметку времени, отдельный поток
+    следит за ней. Если отметка не обновлялась дольше порога, значит цикл занят
+    синхронным кодом: в журнал пишется текущий стек потока цикла событий.
+    """
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.task = None
+        self.stopped = threading.Event()
+    
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-stall-detector", daemon=True).start()
+        logger.info(f"Обнаружение блокировок цикла событий включено, порог {self.threshold} с")
+    
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+    
+    async def heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+    
+    def watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 4):
+            beat = self.beat
+            stalled = time.monotonic() - beat
+            # О каждой блокировке сообщаем один раз
+            if stalled <= self.threshold or beat == reported:
+                continue
+            reported = beat
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            logger.warning(f"Цикл событий заблокирован уже {stalled:.2f} с, текущий стек:\n{stack}")
+
+stall_detector = LoopStallDetector(LOOP_STALL_THRESHOLD) if LOOP_STALL_THRESHOLD > 0 else None
+
+def start_metrics_server():
+    """Запуск HTTP-эндпоинта метрик Prometheus"""
+    USERS.set_function(lambda: len(scheduler))
+    DISTINCT_KEYWORDS.set_function(lambda: len(keyword_index))
+    SCHEDULER_BACKLOG.set_function(lambda: scheduler.backlog(time.time()))
+    DELIVERY_BACKLOG.set_function(lambda: len(delivery))
+    start_http_server(METRICS_PORT)
+    logger.info(f"Метрики доступны на порту {METRICS_PORT}")
+
+async def on_startup(application: Application) -> None:
+    """Запуск фоновых задач бота"""
+    # Уведомления отправляют процессы, выполняющие проверки; рабочий процесс
+    # загружает сообщения своих пользователей по мере их аренды
+    if BOT_ROLE != "front":
+        delivery.start(application.bot, restore=BOT_ROLE == "all")
+    if stall_detector is not None:
+        stall_detector.start()
+    if METRICS_PORT:
+        start_metrics_server()
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке бота"""
+    if stall_detector is not None:
+        stall_detector.stop()
+    await delivery.stop()
+    await close_http_client()
+    if detail_cache is not None:
+        detail_cache.close()
+    if storage is not None:
+        if BOT_ROLE == "worker":
+            # Пользователи сразу переходят к оставшимся процессам, не дожидаясь истечения аренды
+            storage.leave(WORKER_ID)
+        storage.close()
+
+async def run_worker(application: Application) -> None:
+    """Рабочий процесс: проверки и уведомления без приема обновлений Telegram"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        await on_startup(application)
+        await application.start()
+        logger.info(f"Рабочий процесс {WORKER_ID} запущен")
+        await stop_event.wait()
+        await application.stop()
+        await on_shutdown(application)
 
 def main() -> None:
     """Запуск бота"""
+    if BOT_ROLE not in ("all", "front", "worker"):
+        logger.error(f"Неизвестная роль процесса: {BOT_ROLE}")
+        return
+    if UPDATE_MODE not in ("polling", "webhook"):
+        logger.error(f"Неизвестный режим приема обновлений: {UPDATE_MODE}")
+        return
+    if BOT_ROLE != "all" and STORAGE_BACKEND != "sqlite":
+        logger.error("Раздельные процессы front и worker работают только с хранилищем sqlite")
+        return
+    if BOT_ROLE != "worker" and UPDATE_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("Для режима webhook нужно указать WEBHOOK_URL")
+        return
+    
     # Загрузка сохраненных данных
     load_data()
     
     # Создание приложения
-    application = Application.builder().token(TOKEN).build()
+    # Обновления обрабатываются параллельно: долгий /search одного пользователя не задерживает остальных
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    if BOT_ROLE == "worker":
+        # Пользователи, индекс ключевых слов и очередь проверок заполняются при синхронизации
+        application.job_queue.run_repeating(sync_shard, interval=WORKER_HEARTBEAT, first=0)
+        if INGEST_MODE == "firehose":
+            application.job_queue.run_repeating(ingest_firehose, interval=FIREHOSE_INTERVAL, first=5)
+        asyncio.run(run_worker(application))
+        return
+    
+    rebuild_keyword_index()
     
     # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("add_keywords", add_keywords))
-    application.add_handler(CommandHandler("remove_keywords", remove_keywords))
-    application.add_handler(CommandHandler("list_keywords", list_keywords))
-    application.add_handler(CommandHandler("search", search_vacancies))
-    application.add_handler(CommandHandler("settings", settings))
+    application.add_handler(CommandHandler("start", profiled(start)))
+    application.add_handler(CommandHandler("help", profiled(help_command)))
+    application.add_handler(CommandHandler("add_keywords", profiled(add_keywords)))
+    application.add_handler(CommandHandler("remove_keywords", profiled(remove_keywords)))
+    application.add_handler(CommandHandler("list_keywords", profiled(list_keywords)))
+    application.add_handler(CommandHandler("exclude_words", profiled(exclude_words)))
+    application.add_handler(CommandHandler("search", profiled(search_vacancies)))
+    application.add_handler(CommandHandler("settings", profiled(settings)))
     
     # Обработчик кнопок
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(profiled(button_handler)))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_error_handler(error_handler)
     
-    # Запуск периодической проверки новых вакансий
-    job_queue = application.job_queue
-    job_queue.run_repeating(check_new_vacancies, interval=60, first=10)
+    # Запуск периодической проверки новых вакансий (в режиме front ее выполняют рабочие процессы)
+    if BOT_ROLE == "all":
+        load_schedule()
+        arm_scheduler(application.job_queue, first=10)
+        if INGEST_MODE == "firehose":
+            application.job_queue.run_repeating(ingest_firehose, interval=FIREHOSE_INTERVAL, first=5)
     
     # Запуск бота
-    application.run_polling()
+    if UPDATE_MODE == "webhook":
+        logger.info(f"Прием обновлений через webhook на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()